@@ -6,54 +6,59 @@ import asyncpg
 
 import config
 import utils
+from common import metrics
+from common.throttler import TokenBucket
 from datetime import datetime
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(os.environ.get("LOGLEVEL", logging.DEBUG))
 
+# upstream requests budget of the checker, shared by all concurrent probes
+checker_bucket = TokenBucket(rate=config.checker_rate_limit, chat_interval=0)
 
-async def select_random_users_by_region_and_exam(conn, region, exam_id, num_of_users=2):
-    user_ids = set()
-    users_fetched = await conn.fetch(
-        "select * from %s where $1 = any(exams) and region = $2 order by random()" % config.db_table_users,
-        exam_id,
-        region)
-
-    amount_of_users = 0
-    for user in users_fetched:
-        if amount_of_users < num_of_users:
-            user_ids.add(user["chat_id"])
-            amount_of_users += 1
-        else:
-            break
+# stats of the last finished sweep
+sweep_stats = {}
 
-    return user_ids
+checker_sweep_seconds = metrics.Histogram("checker_sweep_seconds", "Time of auto checker sweeps",
+                                          buckets=(1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+checker_sweep_users = metrics.Gauge("checker_sweep_users", "Users probed in the last sweep")
+checker_probes_total = metrics.Counter("checker_probes_total", "Users probed by the auto checker", ("result",))
 
 
-async def select_random_users_by_exams(conn, exams):
+async def select_random_users_by_exams(conn, exams, num_of_users=config.checker_samples_per_exam):
+    """
+    Selects up to {num_of_users} random users for every (region, exam) pair, which is not notified yet,
+    in a single query.
+    """
     user_ids = set()
-    region_rows = await conn.fetch("select * from %s" % config.db_table_regions)
+    # notified (region, exam) pairs are returned with null chat_id, only to be logged
+    rows = await conn.fetch(
+        "select exam_id, region, chat_id from ("
+        "    select ue.exam_id, u.region, u.chat_id, "
+        "           row_number() over (partition by ue.exam_id, u.region order by random()) as n "
+        "    from {users} u cross join unnest(u.exams) ue(exam_id) join {regions} r on r.region = u.region "
+        "    where ue.exam_id = any($1::int[]) and not ue.exam_id = any(r.notified_exams)"
+        ") samples where n <= $2 "
+        "union all "
+        "select e.exam_id, r.region, null from {regions} r cross join unnest($1::int[]) e(exam_id) "
+        "where e.exam_id = any(r.notified_exams)".format(users=config.db_table_users,
+                                                         regions=config.db_table_regions),
+        exams,
+        num_of_users)
+
+    fetched_regions = {exam_id: set() for exam_id in exams}
+    notified_regions = {exam_id: set() for exam_id in exams}
+    for row in rows:
+        if row["chat_id"]:
+            user_ids.add(row["chat_id"])
+            fetched_regions[row["exam_id"]].add(row["region"])
+        else:
+            notified_regions[row["exam_id"]].add(row["region"])
 
     for exam_id in exams:
-        fetched_regions_count = 0
-        notified_regions_count = 0
-
-        for region_row in region_rows:
-            region = region_row["region"]
-            region_exams = region_row["exams"]
-            region_notified_exams = region_row["notified_exams"]
-
-            if exam_id in region_exams and exam_id not in region_notified_exams:
-                users_fetched = await select_random_users_by_region_and_exam(conn, region, exam_id)
-                if users_fetched:
-                    user_ids.update(users_fetched)
-                    fetched_regions_count += 1
-            elif exam_id in region_notified_exams:
-                notified_regions_count += 1
-
         logger.info("Checker regeneration: exam_id: %d, fetched regions count: %d, notified regions: %d",
-                    exam_id, fetched_regions_count, notified_regions_count)
+                    exam_id, len(fetched_regions[exam_id]), len(notified_regions[exam_id]))
 
     return user_ids
 
@@ -71,41 +76,90 @@ async def select_near_exams(conn):
     return exams
 
 
+async def check_user(bot, user_id, user, semaphore, latencies):
+    async with semaphore:
+        await checker_bucket.acquire()
+        time_start = datetime.now().timestamp()
+        e, response = await utils.handle_get_results_json(user_id, from_auto_checker=True, user=user)
+        latencies.append(datetime.now().timestamp() - time_start)
+
+    if response:
+        await utils.check_results_updates(user_id, response, callback_bot=bot, is_user_request=False, user=user)
+    return not e
+
+
+async def check_users(bot, users):
+    """
+    Probes {users} concurrently: not more than config.checker_concurrency requests at once
+    and not more than config.checker_rate_limit requests per second.
+    """
+    semaphore = asyncio.Semaphore(config.checker_concurrency)
+    latencies = []
+    time_start = datetime.now().timestamp()
+
+    results = await asyncio.gather(*(check_user(bot, user_id, user, semaphore, latencies)
+                                     for user_id, user in users.items()), return_exceptions=True)
+
+    total_time = datetime.now().timestamp() - time_start
+    latencies.sort()
+    sweep_stats.update({
+        "users": len(users),
+        "errors": sum(1 for result in results if result is not True),
+        "time": total_time,
+        "requests_per_second": len(latencies) / total_time if total_time > 0 else 0,
+        "latency_p50": latencies[len(latencies) // 2] if latencies else 0,
+        "latency_max": latencies[-1] if latencies else 0
+    })
+
+    checker_sweep_seconds.observe(total_time)
+    checker_sweep_users.set(sweep_stats["users"])
+    checker_probes_total.inc(sweep_stats["users"] - sweep_stats["errors"], result="ok")
+    checker_probes_total.inc(sweep_stats["errors"], result="error")
+
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning("Checker: an unexpected error happened: %s", result)
+    logger.info("Checker: sweep of %d users (%d errors) in %f secs, %.1f requests/sec, "
+                "latency p50 %.3f secs, max %.3f secs",
+                sweep_stats["users"], sweep_stats["errors"], sweep_stats["time"],
+                sweep_stats["requests_per_second"], sweep_stats["latency_p50"], sweep_stats["latency_max"])
+
+
 async def check_thread_runner(bot):
     logger.info("Checker: started")
     samples_age = datetime.now().timestamp()
     samples_need_to_regenerate = False
 
     db_conn = await asyncpg.connect(dsn=config.db_url)
-
-    exams = await select_near_exams(db_conn)
-    users_samples = await select_random_users_by_exams(db_conn, exams)
-
-    while True:
-        if exams:
-            time_loop = datetime.now().timestamp()
-            try:
-                for user_id in users_samples:
-                    if await utils.user_check_logged(user_id):
-                        e, response = await utils.handle_get_results_json(user_id, from_auto_checker=True)
-                        await asyncio.sleep(config.relax_checker)
-
-                        if response:
-                            await utils.check_results_updates(user_id, response, callback_bot=bot,
-                                                              is_user_request=False)
-                    else:
+    try:
+        exams = await select_near_exams(db_conn)
+        users_samples = await select_random_users_by_exams(db_conn, exams)
+
+        while True:
+            if exams:
+                time_loop = datetime.now().timestamp()
+                try:
+                    logged_users = await utils.users_filter_logged(users_samples)
+                    if len(logged_users) < len(users_samples):
                         samples_need_to_regenerate = True
-            except:
-                logger.warning("Checker: an unexpected error happened")
-
-            time_stop = datetime.now().timestamp()
-            logger.info("Checker: loop time %f secs", time_stop - time_loop)
 
-            if datetime.now().timestamp() - samples_age > 600 or samples_need_to_regenerate:
-                samples_age = datetime.now().timestamp()
-                exams = await select_near_exams(db_conn)
-                users_samples = await select_random_users_by_exams(db_conn, exams)
-
-        else:
-            logger.warning("Checker: exams list is empty, waiting for 2 hours...")
-            await asyncio.sleep(60 * 60 * 2)
+                    await check_users(bot, logged_users)
+                except Exception:
+                    logger.warning("Checker: an unexpected error happened")
+
+                time_stop = datetime.now().timestamp()
+                logger.info("Checker: loop time %f secs", time_stop - time_loop)
+                await asyncio.sleep(config.relax_checker)
+
+                if datetime.now().timestamp() - samples_age > 600 or samples_need_to_regenerate:
+                    samples_age = datetime.now().timestamp()
+                    samples_need_to_regenerate = False
+                    exams = await select_near_exams(db_conn)
+                    users_samples = await select_random_users_by_exams(db_conn, exams)
+
+            else:
+                logger.warning("Checker: exams list is empty, waiting for 2 hours...")
+                await asyncio.sleep(60 * 60 * 2)
+    finally:
+        # the checker is cancelled when this replica loses the leadership
+        db_conn.terminate()
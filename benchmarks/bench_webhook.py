@@ -0,0 +1,92 @@
+"""
+Throughput of updates ingestion: long polling against webhook mode, both fed by a local fake Bot API
+running in its own process (it also plays Telegram delivering updates to the webhook).
+Every synthetic update is a "Помощь" message from a separate chat, which goes through the real
+dispatcher and sends one answer, no database is used.
+
+    python3 benchmarks/bench_webhook.py [updates_count] [bot_api_latency_secs]
+"""
+import asyncio
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("ADMIN_CHAT_IDS", "")
+os.environ.setdefault("TG_API_TOKEN", "123456:bench")
+os.environ.setdefault("LOGLEVEL", "WARNING")
+
+from aiogram import Bot, Dispatcher
+from aiogram.dispatcher.webhook import configure_app
+from aiohttp import web
+
+import config
+import main
+from fake_telegram import FakeTelegramClient, message_update
+
+TELEGRAM_PORT = 18181
+WEBHOOK_PORT = 18182
+WEBHOOK_CONCURRENCY = config.webhook_max_connections
+
+
+def updates(updates_count, first_chat_id):
+    return [message_update(chat_id, chat_id, "Помощь ℹ️")
+            for chat_id in range(first_chat_id, first_chat_id + updates_count)]
+
+
+async def bench_polling(telegram, updates_count, first_chat_id):
+    sent_before = (await telegram.calls())["sendMessage"]
+    time_start = time.perf_counter()
+    await telegram.put_updates(updates(updates_count, first_chat_id))
+
+    polling = asyncio.create_task(main.dp.start_polling(allowed_updates=main.allowed_updates))
+    await telegram.wait_calls("sendMessage", sent_before + updates_count)
+    total_time = time.perf_counter() - time_start
+
+    main.dp.stop_polling()
+    await polling
+    return total_time
+
+
+async def bench_webhook(telegram, updates_count, first_chat_id):
+    app = web.Application()
+    configure_app(main.dp, app, "/webhook")
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", WEBHOOK_PORT).start()
+
+    sent_before = (await telegram.calls())["sendMessage"]
+    time_start = time.perf_counter()
+    await telegram.deliver_webhook("http://127.0.0.1:%d/webhook" % WEBHOOK_PORT,
+                                   updates(updates_count, first_chat_id), WEBHOOK_CONCURRENCY)
+    await telegram.wait_calls("sendMessage", sent_before + updates_count)
+    total_time = time.perf_counter() - time_start
+
+    await runner.cleanup()
+    return total_time
+
+
+async def main_bench(updates_count, latency):
+    telegram = FakeTelegramClient(TELEGRAM_PORT, latency=latency)
+    await telegram.start()
+    main.bot.server = telegram.server
+    Bot.set_current(main.bot)
+    Dispatcher.set_current(main.dp)
+
+    try:
+        print("%d updates, each is answered with one message, Bot API latency %.3f secs\n" % (updates_count, latency))
+        print("%-10s %10s %14s" % ("mode", "time, s", "updates/sec"))
+        for mode, bench, first_chat_id in (("polling", bench_polling, 10 ** 9),
+                                           ("webhook", bench_webhook, 2 * 10 ** 9)):
+            total_time = await bench(telegram, updates_count, first_chat_id)
+            print("%-10s %10.2f %14.1f" % (mode, total_time, updates_count / total_time))
+    finally:
+        await (await main.bot.get_session()).close()
+        telegram.stop()
+
+
+if __name__ == '__main__':
+    logging.getLogger("aiogram").setLevel(logging.WARNING)
+    asyncio.run(main_bench(int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+                           float(sys.argv[2]) if len(sys.argv) > 2 else 0.05))
@@ -0,0 +1,115 @@
+"""
+Local stand-in for checkege (captcha, login and exams API) with configurable latency, errors and results releases.
+Exams are taken from tests/test_response.json, their ids are shifted by EXAM_ID_OFFSET not to mix with real ones.
+Run the bot with EGE_BASE_URL pointing to it.
+"""
+import ast
+import asyncio
+import base64
+import os
+import random
+import time
+import uuid
+from collections import Counter
+from hashlib import md5
+
+from aiohttp import web
+
+from fake_server import FakeServerProcess
+
+EXAM_ID_OFFSET = 9000
+RESPONSE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests",
+                             "test_response.json")
+
+
+def load_exams():
+    # the file is a python literal (None/False), not json
+    with open(RESPONSE_PATH, encoding="utf-8") as file:
+        exams = ast.literal_eval(file.read())
+    for exam in exams:
+        exam["ExamId"] += EXAM_ID_OFFSET
+    return exams
+
+
+class FakeCheckege:
+    def __init__(self, latency=0.0, error_rate=0.0, released=(), release_after=None):
+        """
+        Answers after {latency} seconds, {error_rate} of requests fail with HTTP 503.
+        Results of exams are hidden until released: exams in {released} are released from the start,
+        {release_after} maps exam_id to seconds after the start, POST /control/release releases them at once.
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.exams = load_exams()
+        self.released = set(released)
+        self.release_after = release_after or {}
+        self.time_start = time.monotonic()
+        self.calls = Counter()
+
+    def app(self):
+        app = web.Application()
+        app.router.add_route("GET", "/api/captcha", self._handle_captcha)
+        app.router.add_route("POST", "/api/participant/login", self._handle_login)
+        app.router.add_route("GET", "/api/exam", self._handle_exams)
+        app.router.add_route("POST", "/control/release", self._handle_release)
+        app.router.add_route("GET", "/control/calls", self._handle_calls)
+        return app
+
+    async def _answer(self, name):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if random.random() < self.error_rate:
+            self.calls[name + ":error"] += 1
+            raise web.HTTPServiceUnavailable()
+        self.calls[name] += 1
+
+    def _is_released(self, exam_id):
+        if exam_id in self.released:
+            return True
+        after = self.release_after.get(exam_id)
+        return after is not None and time.monotonic() - self.time_start >= after
+
+    async def _handle_captcha(self, request):
+        await self._answer("captcha")
+        return web.json_response({"Token": uuid.uuid4().hex, "Image": base64.b64encode(b"captcha").decode()})
+
+    async def _handle_login(self, request):
+        await self._answer("login")
+        params = await request.post()
+        response = web.Response(status=204)
+        response.set_cookie("Participant", md5((params["Hash"] + params.get("Document", params.get("Code", "")))
+                                               .encode()).hexdigest())
+        return response
+
+    async def _handle_exams(self, request):
+        token = request.cookies.get("Participant")
+        if not token:
+            raise web.HTTPUnauthorized()
+        await self._answer("exams")
+
+        exams = []
+        for exam in self.exams:
+            exam = dict(exam)
+            if not exam["IsComposition"]:
+                if self._is_released(exam["ExamId"]):
+                    exam["TestMark"] = 40 + int(token[:4], 16) % 60
+                    exam["HasResult"] = True
+                else:
+                    exam["TestMark"] = 0
+                    exam["HasResult"] = False
+            exams.append(exam)
+        return web.json_response({"Result": {"Exams": exams}})
+
+    async def _handle_release(self, request):
+        self.released.update((await request.json())["exam_ids"])
+        return web.json_response({"ok": True})
+
+    async def _handle_calls(self, request):
+        return web.json_response(dict(self.calls))
+
+
+class FakeCheckegeClient(FakeServerProcess):
+    server_class = FakeCheckege
+
+    async def release(self, *exam_ids):
+        await self._request("POST", "/control/release", {"exam_ids": list(exam_ids)})
@@ -0,0 +1,60 @@
+"""
+Runs a fake aiohttp server in a child process (so it doesn't share CPU with the bot) and talks to its /control API.
+"""
+import asyncio
+import multiprocessing
+import time
+from collections import Counter
+
+import aiohttp
+from aiohttp import web
+
+
+def _serve(server_class, port, kwargs):
+    web.run_app(server_class(**kwargs).app(), host="127.0.0.1", port=port, access_log=None, print=None)
+
+
+class FakeServerProcess:
+    server_class = None
+
+    def __init__(self, port, **kwargs):
+        """
+        Starts {server_class}(**kwargs) on {port} in a child process,
+        the server has to serve GET /control/calls with counters of handled requests.
+        """
+        self.port = port
+        self.base_url = "http://127.0.0.1:%d" % port
+        self._process = multiprocessing.Process(target=_serve, args=(self.server_class, port, kwargs), daemon=True)
+
+    async def start(self):
+        self._process.start()
+        async with aiohttp.ClientSession() as session:
+            for _ in range(100):
+                try:
+                    async with session.get(self.base_url + "/control/calls"):
+                        return
+                except aiohttp.ClientConnectionError:
+                    await asyncio.sleep(0.05)
+        raise RuntimeError("%s did not start" % self.server_class.__name__)
+
+    def stop(self):
+        self._process.terminate()
+        self._process.join()
+
+    async def _request(self, method, path, data=None, params=None):
+        async with aiohttp.ClientSession() as session:
+            async with session.request(method, self.base_url + path, json=data, params=params) as response:
+                return await response.json()
+
+    async def calls(self):
+        return Counter(await self._request("GET", "/control/calls"))
+
+    async def wait_calls(self, method, count, timeout=120):
+        time_start = time.perf_counter()
+        while True:
+            calls = await self.calls()
+            if calls[method] >= count:
+                return calls
+            if time.perf_counter() - time_start > timeout:
+                raise TimeoutError("%s: %d of %d calls" % (method, calls[method], count))
+            await asyncio.sleep(0.02)
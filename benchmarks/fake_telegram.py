@@ -0,0 +1,143 @@
+"""
+Local stand-in for the Telegram Bot API, enough for the bot handlers, mailers, long polling and webhooks.
+It runs in a separate process and is driven over HTTP with FakeTelegramClient:
+enqueue updates for getUpdates, deliver them to a webhook, read call counters and times.
+"""
+import asyncio
+import random
+import time
+from collections import Counter, defaultdict
+
+import aiohttp
+from aiogram.bot.api import TelegramAPIServer
+from aiohttp import web
+
+from fake_server import FakeServerProcess
+
+
+class FakeTelegram:
+    def __init__(self, latency=0.0, retry_after_rate=0.0, retry_after=1):
+        """
+        Answers every Bot API method after {latency} seconds,
+        {retry_after_rate} of sends fail with "Too Many Requests: retry after {retry_after}".
+        """
+        self.latency = latency
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+
+        self.calls = Counter()
+        self.call_times = defaultdict(list)
+        self.updates = []
+        self._message_id = 0
+        self._new_updates = asyncio.Event()
+
+    def app(self):
+        app = web.Application(client_max_size=64 * 1024 ** 2)
+        app.router.add_route("POST", "/bot{token}/{method}", self._handle_method)
+        app.router.add_route("POST", "/control/updates", self._handle_put_updates)
+        app.router.add_route("POST", "/control/webhook", self._handle_deliver_webhook)
+        app.router.add_route("GET", "/control/calls", self._handle_calls)
+        app.router.add_route("GET", "/control/call_times", self._handle_call_times)
+        return app
+
+    async def _handle_method(self, request):
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method in ("sendMessage", "sendPhoto", "editMessageText") and random.random() < self.retry_after_rate:
+            self.calls[method + ":RetryAfter"] += 1
+            return web.json_response({"ok": False, "error_code": 429,
+                                      "description": "Too Many Requests: retry after %d" % self.retry_after,
+                                      "parameters": {"retry_after": self.retry_after}})
+
+        self.calls[method] += 1
+        self.call_times[method].append(time.time())
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": await self._get_updates(params)})
+        return web.json_response({"ok": True, "result": self._result(method, params)})
+
+    async def _get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        self.updates = [update for update in self.updates if update["update_id"] >= offset]
+        if not self.updates:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), min(float(params.get("timeout") or 0), 1))
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:limit]
+
+    def _result(self, method, params):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "EgeCheckBot", "username": "EgeCheckBot"}
+        if method in ("sendMessage", "sendPhoto", "sendSticker", "editMessageText"):
+            self._message_id += 1
+            return {"message_id": int(params.get("message_id") or self._message_id), "date": int(time.time()),
+                    "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                    "text": params.get("text", "")}
+        return True
+
+    async def _handle_put_updates(self, request):
+        self.updates.extend(await request.json())
+        self._new_updates.set()
+        return web.json_response({"ok": True})
+
+    async def _handle_deliver_webhook(self, request):
+        # like Telegram: up to {concurrency} parallel connections, each sends updates one by one
+        params = await request.json()
+        updates = iter(params["updates"])
+
+        async def connection(session):
+            for update in updates:
+                async with session.post(params["url"], json=update) as response:
+                    await response.read()
+
+        time_start = time.perf_counter()
+        async with aiohttp.ClientSession() as session:
+            await asyncio.gather(*(connection(session) for _ in range(params["concurrency"])))
+        return web.json_response({"ok": True, "time": time.perf_counter() - time_start})
+
+    async def _handle_calls(self, request):
+        return web.json_response(dict(self.calls))
+
+    async def _handle_call_times(self, request):
+        return web.json_response(self.call_times[request.query["method"]])
+
+
+class FakeTelegramClient(FakeServerProcess):
+    server_class = FakeTelegram
+
+    @property
+    def server(self):
+        return TelegramAPIServer.from_base(self.base_url)
+
+    async def put_updates(self, updates):
+        await self._request("POST", "/control/updates", updates)
+
+    async def deliver_webhook(self, url, updates, concurrency=40):
+        return (await self._request("POST", "/control/webhook",
+                                    {"url": url, "updates": updates, "concurrency": concurrency}))["time"]
+
+    async def call_times(self, method):
+        """
+        Returns unix times of all successful {method} calls.
+        """
+        return await self._request("GET", "/control/call_times", params={"method": method})
+
+
+def message_update(update_id, chat_id, text):
+    return {"update_id": update_id,
+            "message": {"message_id": 1, "date": int(time.time()), "text": text,
+                        "chat": {"id": chat_id, "type": "private"},
+                        "from": {"id": chat_id, "is_bot": False, "first_name": "User"}}}
+
+
+def callback_update(update_id, chat_id, data, message_id=1):
+    return {"update_id": update_id,
+            "callback_query": {"id": str(update_id), "chat_instance": "0", "data": data,
+                               "from": {"id": chat_id, "is_bot": False, "first_name": "User"},
+                               "message": {"message_id": message_id, "date": int(time.time()), "text": "",
+                                           "chat": {"id": chat_id, "type": "private"}}}}
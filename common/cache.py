@@ -0,0 +1,68 @@
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, max_size=10000, ttl=5):
+        """
+        In-memory LRU cache: keeps up to {max_size} items, each for not longer than {ttl} seconds.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # invalidation counters of recently written keys, a read is stored only if its key wasn't written meanwhile;
+        # forgetting a counter (or clear()) bumps the epoch, so reads which started before it are not stored
+        self._versions = OrderedDict()
+        self._epoch = 0
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=MISSING):
+        item = self._items.get(key)
+        if item is not None:
+            value, expires_at = item
+            if expires_at > time.monotonic():
+                self._items.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._items[key]
+
+        self.misses += 1
+        return default
+
+    def version(self, key):
+        """
+        Returns the version of {key}, it is passed to set() along with the value read after this call.
+        """
+        return self._epoch, self._versions.get(key, 0)
+
+    def set(self, key, value, version=None):
+        # a value read before the last invalidation of the key may be already outdated, so it is not stored
+        if version is not None and version != self.version(key):
+            return
+
+        self._items[key] = (value, time.monotonic() + self.ttl)
+        self._items.move_to_end(key)
+        if len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def invalidate(self, key):
+        self._versions[key] = self._versions.get(key, 0) + 1
+        self._versions.move_to_end(key)
+        if len(self._versions) > self.max_size:
+            self._versions.popitem(last=False)
+            self._epoch += 1
+        self._items.pop(key, None)
+
+    def clear(self):
+        self._epoch += 1
+        self._versions.clear()
+        self._items.clear()
+
+    def stats(self):
+        return "size: %d, hits: %d, misses: %d" % (len(self._items), self.hits, self.misses)
@@ -0,0 +1,63 @@
+import asyncio
+import logging
+import os
+from collections import defaultdict
+
+import config
+from common.db import counters_table
+from common.db_worker import DbTable
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOGLEVEL", logging.DEBUG))
+
+
+class Counters:
+    def __init__(self, table: DbTable, flush_interval=5):
+        """
+        Write-behind counters: add() only increments a value in memory,
+        run() writes accumulated increments to {table} every {flush_interval} seconds in one batch.
+        """
+        self.table = table
+        self.flush_interval = flush_interval
+        self._pending = defaultdict(int)
+
+    def add(self, name, value=1):
+        self._pending[name] += value
+
+    async def get_all(self, prefix=""):
+        rows = await self.table.custom_fetch(
+            "select name, value from %s where starts_with(name, $1)" % self.table.name, prefix)
+        values = {row["name"]: row["value"] for row in rows}
+        for name, value in self._pending.items():
+            if name.startswith(prefix):
+                values[name] = values.get(name, 0) + value
+        return values
+
+    def _restore(self, pending):
+        for name, value in pending.items():
+            self._pending[name] += value
+
+    async def flush(self):
+        pending, self._pending = self._pending, defaultdict(int)
+        try:
+            await self.table.increment_many("value", pending)
+        except Exception as e:
+            # not written increments are kept for the next flush
+            self._restore(pending)
+            logger.warning("Counters: flush of %d counters failed: %s", len(pending), e)
+        except BaseException:
+            # cancelled while writing (run() on shutdown), close() writes them
+            self._restore(pending)
+            raise
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def close(self):
+        await self.flush()
+
+
+counters = Counters(counters_table, flush_interval=config.counters_flush_interval)
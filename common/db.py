@@ -5,6 +5,7 @@ from pypika import Column
 
 import config
 from common import db_worker
+from common.cache import TTLCache
 from common.db_worker import DbTable
 
 logging.basicConfig()
@@ -21,7 +22,11 @@ users_table = DbTable(config.db_table_users,
                        Column("login_date", "int"),
                        Column("exams", "int[]", default="{}"),
                        Column("exams_hash", "text")),
-                      pk_id="chat_id")
+                      pk_id="chat_id",
+                      indexes=({"columns": ["exams"], "method": "gin"},
+                               # mailer recipients: only subscribed users of the region
+                               {"name": "users_region_notified_idx", "columns": ["region"], "where": "notify = 1"}),
+                      cache=TTLCache(max_size=config.users_cache_size, ttl=config.users_cache_ttl))
 login_table = DbTable(config.db_table_login,
                       (Column("chat_id", "bigint", nullable=False),
                        Column("status", "text", nullable=False),
@@ -53,21 +58,65 @@ stats_table = DbTable(config.db_table_stats,
                        Column("region", "int")),
                       pk_id="user_hash")
 
+counters_table = DbTable(config.db_table_counters,
+                         (Column("name", "text", nullable=False),
+                          Column("value", "bigint", nullable=False, default=0)),
+                         pk_id="name")
+
+broadcasts_table = DbTable(config.db_table_broadcasts,
+                           (Column("id", "text", nullable=False),
+                            Column("region", "int", nullable=False),
+                            Column("exam_id", "int", nullable=False),
+                            Column("title", "text", nullable=False),
+                            Column("users_count", "int", nullable=False, default=0),
+                            Column("sent_count", "int", nullable=False, default=0),
+                            Column("failed_count", "int", nullable=False, default=0),
+                            Column("created_at", "int", nullable=False),
+                            Column("finished_at", "int")),
+                           pk_id="id")
+
+# notifications not sent yet, one row per recipient, taken by mailers with "for update skip locked"
+outbox_table = DbTable(config.db_table_outbox,
+                       (Column("id", "bigserial", nullable=False),
+                        Column("broadcast_id", "text", nullable=False),
+                        Column("chat_id", "bigint", nullable=False),
+                        Column("locked_until", "int", nullable=False, default=0)),
+                       pk_id="id",
+                       indexes=({"columns": ["broadcast_id"]},))
+
+# the last checkege response of every user, a short-living cache which survives restarts
+results_table = DbTable(config.db_table_results,
+                        (Column("chat_id", "bigint", nullable=False),
+                         Column("exams", "jsonb", nullable=False),
+                         Column("updated_at", "int", nullable=False)),
+                        pk_id="chat_id")
+
 
-async def init_db():
+async def init_db(server_settings=None):
+    """
+    Connects to the database and creates missing tables, {server_settings} are passed to every connection.
+    """
     global conn_pool
     global users_table
     global login_table
     global regions_table
     global examsinfo_table
     global stats_table
+    global counters_table
+    global broadcasts_table
+    global outbox_table
+    global results_table
 
-    conn_pool = await db_worker.create_db_connection_pool()
+    conn_pool = await db_worker.create_db_connection_pool(server_settings=server_settings)
 
     await users_table.create_and_init_table(conn_pool)
     await login_table.create_and_init_table(conn_pool)
     await regions_table.create_and_init_table(conn_pool)
     await examsinfo_table.create_and_init_table(conn_pool)
     await stats_table.create_and_init_table(conn_pool)
+    await counters_table.create_and_init_table(conn_pool)
+    await broadcasts_table.create_and_init_table(conn_pool)
+    await outbox_table.create_and_init_table(conn_pool)
+    await results_table.create_and_init_table(conn_pool)
 
     logger.info("Databases were initialized successfully.")
@@ -1,24 +1,35 @@
 import logging
 import os
-from typing import Dict, Any
+from contextlib import asynccontextmanager
+from typing import Dict, Any, Iterable, List
 
 import asyncpg
 from asyncpg import Record
-from pypika import Table, Query, Parameter, Field
+from pypika import Table, Query, PostgreSQLQuery, Parameter, Field, CustomFunction
+from pypika.terms import LiteralValue
 
 import config
+from common import metrics
+from common.cache import TTLCache, MISSING
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(os.environ.get("LOGLEVEL", logging.DEBUG))
 
+ArrayAny = CustomFunction("ANY", ["array"])
+
+db_query_seconds = metrics.Histogram("db_query_seconds", "Time of DbTable queries, including waiting for a connection",
+                                     ("table", "operation"))
+db_errors_total = metrics.Counter("db_errors_total", "Failed DbTable queries", ("table", "operation", "error"))
+
 
 async def create_db_connection():
     return await asyncpg.connect(dsn=config.db_url)
 
 
-async def create_db_connection_pool(threads=10):
-    return await asyncpg.create_pool(dsn=config.db_url, min_size=threads, max_size=threads)
+async def create_db_connection_pool(threads=10, server_settings=None):
+    return await asyncpg.create_pool(dsn=config.db_url, min_size=threads, max_size=threads,
+                                     server_settings=server_settings)
 
 
 class DbTable:
@@ -28,13 +39,20 @@ class DbTable:
     _pk_id = None
     _if_not_exists = None
     _foreign_key_settings = None
+    _indexes = None
+    _compiled_queries = None
+    _cache: TTLCache = None
 
-    def __init__(self, name, columns, pk_id=None, if_not_exists=True, foreign_key_settings=None):
+    def __init__(self, name, columns, pk_id=None, if_not_exists=True, foreign_key_settings=None, indexes=None,
+                 cache=None):
         self._table = Table(name)
         self._columns = columns
         self._pk_id = pk_id
         self._if_not_exists = if_not_exists
         self._foreign_key_settings = foreign_key_settings
+        self._indexes = indexes
+        self._compiled_queries = {}
+        self._cache = cache
 
     async def create_and_init_table(self, conn_pool):
         try:
@@ -61,42 +79,190 @@ class DbTable:
         except asyncpg.exceptions.DuplicateTableError:
             pass
 
+        # indexes are created separately, so they are added to already existing tables as well;
+        # concurrently (outside of a transaction), not to block writes to a big table while an index is built
+        if self._indexes:
+            for index in self._indexes:
+                name = index.get("name") or "{}_{}_idx".format(self._table.get_table_name(),
+                                                               "_".join(index["columns"]))
+                query = "CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} USING {method} ({columns}) " \
+                        "{where}".format(name=name,
+                                         table=self._table,
+                                         method=index.get("method", "btree"),
+                                         columns=",".join(index["columns"]),
+                                         where="WHERE %s" % index["where"] if index.get("where") else "")
+                async with self._conn_pool.acquire() as conn:
+                    await conn.execute(query)
+                    # a failed concurrent build leaves an invalid index, which is skipped by "if not exists"
+                    # (it is also invalid while another replica builds it, so it is not dropped here)
+                    if await conn.fetchval("SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1)",
+                                           name):
+                        logger.warning("Index %s is invalid (failed or still being built)", name)
+
+    def _compiled_query(self, operation, columns=(), merge_arrays=()):
+        """
+        Returns SQL of {operation} over {columns}, rendered by pypika once per query shape.
+        Values are bound as $1..$n parameters, the key goes last.
+        """
+        query_shape = (operation, columns, merge_arrays)
+        if query_shape not in self._compiled_queries:
+            params = [Parameter("${:d}".format(i + 1)) for i in range(len(columns) + 1)]
+            if operation == "get":
+                query = Query.from_(self._table).select("*").where(Field(self._pk_id) == params[0])
+            elif operation == "insert":
+                query = Query.into(self._table).columns(*columns).insert(*params[:-1])
+            elif operation == "update":
+                query = Query.update(self._table)
+                for column, param in zip(columns, params):
+                    query = query.set(column, param)
+                query = query.where(Field(self._pk_id) == params[-1])
+            elif operation == "delete":
+                query = Query.from_(self._table).delete().where(Field(self._pk_id) == params[0])
+            elif operation == "increment":
+                column = columns[0]
+                query = PostgreSQLQuery.into(self._table).columns(self._pk_id, column).insert(*params) \
+                    .on_conflict(self._pk_id) \
+                    .do_update(column, LiteralValue('{table}."{column}" + EXCLUDED."{column}"'.format(
+                        table=self._table, column=column)))
+            elif operation == "get_many":
+                query = Query.from_(self._table).select("*").where(Field(self._pk_id) == ArrayAny(params[0]))
+            elif operation == "delete_many":
+                query = Query.from_(self._table).delete().where(Field(self._pk_id) == ArrayAny(params[0]))
+            elif operation == "upsert":
+                query = PostgreSQLQuery.into(self._table).columns(*columns).insert(*params[:-1]) \
+                    .on_conflict(self._pk_id)
+                update_columns = [column for column in columns if column != self._pk_id]
+                if update_columns:
+                    for column in update_columns:
+                        if column in merge_arrays:
+                            # union of the stored and the new array, without duplicates
+                            query = query.do_update(column, LiteralValue(
+                                'array(select distinct unnest({table}."{column}" || EXCLUDED."{column}"))'.format(
+                                    table=self._table, column=column)))
+                        else:
+                            query = query.do_update(column)
+                else:
+                    query = query.do_nothing()
+            else:
+                raise ValueError("Unknown operation: %s" % operation)
+            self._compiled_queries[query_shape] = query.get_sql()
+
+        return self._compiled_queries[query_shape]
+
+    def _invalidate(self, key):
+        # called after a write, so a read that started before it is not put into the cache
+        if self._cache is not None:
+            self._cache.invalidate(key)
+
+    def _invalidate_many(self, keys):
+        if self._cache is not None:
+            for key in keys:
+                self._cache.invalidate(key)
+
+    @asynccontextmanager
+    async def _query(self, operation):
+        with db_query_seconds.time(table=self.name, operation=operation):
+            try:
+                async with self._conn_pool.acquire() as conn:
+                    yield conn
+            except Exception as e:
+                db_errors_total.inc(table=self.name, operation=operation, error=type(e).__name__)
+                raise
+
+    @property
+    def name(self):
+        return self._table.get_table_name()
+
+    @property
+    def cache(self) -> TTLCache:
+        return self._cache
+
     async def get(self, key) -> Record:
-        query = Query.from_(self._table) \
-            .select("*") \
-            .where(Field(self._pk_id) == key)
-        async with self._conn_pool.acquire() as conn:
-            return await conn.fetchrow(query.get_sql())
+        if self._cache is not None:
+            row = self._cache.get(key)
+            if row is not MISSING:
+                return row
+            cache_version = self._cache.version(key)
+
+        # the same SQL text every time, so asyncpg reuses the statement prepared on the connection
+        async with self._query("get") as conn:
+            row = await conn.fetchrow(self._compiled_query("get"), key)
+
+        if self._cache is not None:
+            self._cache.set(key, row, cache_version)
+        return row
 
     async def insert(self, updates: Dict[str, Any]):
-        query = Query.into(self._table) \
-            .columns(*updates.keys()) \
-            .insert(*(Parameter("${:d}".format(i + 1)) for i in range(len(updates))))
-        async with self._conn_pool.acquire() as conn:
-            await conn.execute(query.get_sql(), *updates.values())
+        async with self._query("insert") as conn:
+            await conn.execute(self._compiled_query("insert", tuple(updates.keys())), *updates.values())
+        self._invalidate(updates.get(self._pk_id))
 
     async def update(self, key, updates: Dict[str, Any]):
-        param_count = 0
-        query = Query.update(self._table)
-        for update in updates.keys():
-            param_count += 1
-            query = query.set(update, Parameter("${:d}".format(param_count)))
-        query = query.where(Field(self._pk_id) == key)
-        async with self._conn_pool.acquire() as conn:
-            await conn.execute(query.get_sql(), *updates.values())
+        async with self._query("update") as conn:
+            await conn.execute(self._compiled_query("update", tuple(updates.keys())), *updates.values(), key)
+        self._invalidate(key)
+
+    async def upsert(self, updates: Dict[str, Any], merge_arrays=()):
+        """
+        Inserts a row or updates the existing one with the same primary key in one atomic query.
+        Array columns listed in {merge_arrays} are merged with the stored values instead of being replaced.
+        """
+        query = self._compiled_query("upsert", tuple(updates.keys()), tuple(merge_arrays))
+        async with self._query("upsert") as conn:
+            await conn.execute(query, *updates.values())
+        self._invalidate(updates.get(self._pk_id))
 
     async def delete(self, key):
-        query = Query.from_(self._table) \
-            .delete() \
-            .where(Field(self._pk_id) == key)
-        async with self._conn_pool.acquire() as conn:
-            await conn.execute(query.get_sql())
+        async with self._query("delete") as conn:
+            status = await conn.execute(self._compiled_query("delete"), key)
+        self._invalidate(key)
+        return status != "DELETE 0"
+
+    async def get_many(self, keys: Iterable) -> List[Record]:
+        async with self._query("get_many") as conn:
+            return await conn.fetch(self._compiled_query("get_many"), list(keys))
+
+    async def insert_many(self, rows: List[Dict[str, Any]]):
+        if rows:
+            columns = list(rows[0].keys())
+            async with self._query("insert_many") as conn:
+                await conn.copy_records_to_table(self._table.get_table_name(),
+                                                 records=[tuple(row[column] for column in columns) for row in rows],
+                                                 columns=columns)
+            self._invalidate_many(row.get(self._pk_id) for row in rows)
+
+    async def upsert_many(self, rows: List[Dict[str, Any]], merge_arrays=()):
+        """
+        Inserts {rows} (all with the same keys, including the primary key) in one round trip,
+        existing rows get the given columns updated.
+        """
+        if rows:
+            columns = tuple(rows[0].keys())
+            query = self._compiled_query("upsert", columns, tuple(merge_arrays))
+            async with self._query("upsert_many") as conn:
+                await conn.executemany(query, [tuple(row[column] for column in columns) for row in rows])
+            self._invalidate_many(row.get(self._pk_id) for row in rows)
+
+    async def delete_many(self, keys: Iterable):
+        keys = list(keys)
+        async with self._query("delete_many") as conn:
+            await conn.execute(self._compiled_query("delete_many"), keys)
+        self._invalidate_many(keys)
+
+    async def increment_many(self, column, increments: Dict[Any, int]):
+        """
+        Atomically adds values of {increments} to {column} of rows with the given keys, missing rows are created.
+        """
+        if increments:
+            async with self._query("increment_many") as conn:
+                await conn.executemany(self._compiled_query("increment", (column,)), list(increments.items()))
+            self._invalidate_many(increments.keys())
 
     async def count(self):
-        async with self._conn_pool.acquire() as conn:
+        async with self._query("count") as conn:
             res = await conn.fetchrow("SELECT COUNT(*) FROM {}".format(self._table))
             return res["count"]
 
     async def custom_fetch(self, query, *params):
-        async with self._conn_pool.acquire() as conn:
+        async with self._query("custom_fetch") as conn:
             return await conn.fetch(query, *params)
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import os
+
+import asyncpg
+
+import config
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOGLEVEL", logging.DEBUG))
+
+
+class LeaderElection:
+    def __init__(self, lock_id, check_interval=5):
+        """
+        Elects one leader among all bot replicas with Postgres advisory lock {lock_id}.
+        Tasks added with add_task() run only in the leader and are cancelled as soon as the leadership is lost.
+        Every {check_interval} seconds followers try to take the lock and the leader checks that it still holds it.
+        """
+        self.lock_id = lock_id
+        self.check_interval = check_interval
+        self.is_leader = False
+        self._task_factories = []
+
+    def add_task(self, coroutine_function, *args):
+        self._task_factories.append((coroutine_function, args))
+
+    async def _connect(self):
+        # the lock belongs to the session: if the leader dies or hangs, Postgres drops
+        # the connection after keepalive probes fail and the lock goes to another replica
+        return await asyncpg.connect(dsn=config.db_url, server_settings={
+            "tcp_keepalives_idle": str(self.check_interval),
+            "tcp_keepalives_interval": str(self.check_interval),
+            "tcp_keepalives_count": "2",
+            "application_name": "ege_bot_leader_election"})
+
+    async def _lead(self, conn):
+        self.is_leader = True
+        logger.warning("Leader election: this replica is the leader now")
+        tasks = [asyncio.create_task(coroutine_function(*args)) for coroutine_function, args in self._task_factories]
+        try:
+            while True:
+                await asyncio.sleep(self.check_interval)
+                for task in tasks:
+                    if task.done():
+                        raise RuntimeError("leader task %s stopped: %s" % (task.get_coro().__qualname__,
+                                                                           task.exception()))
+                # if the connection is broken, another replica may already hold the lock
+                await asyncio.wait_for(conn.fetchval("select 1"), self.check_interval)
+        finally:
+            self.is_leader = False
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            logger.warning("Leader election: leadership is released")
+
+    async def has_leader(self):
+        """
+        Returns True if some replica holds the lock, i.e. at least one replica is running.
+        """
+        conn = await self._connect()
+        try:
+            return await conn.fetchval(
+                "select exists(select 1 from pg_locks where locktype = 'advisory' and granted "
+                "and (classid::bigint << 32 | objid::bigint) = $1 and objsubid = 1)", self.lock_id)
+        finally:
+            conn.terminate()
+
+    async def run(self):
+        while True:
+            conn = None
+            try:
+                conn = await self._connect()
+                while not await conn.fetchval("select pg_try_advisory_lock($1)", self.lock_id):
+                    await asyncio.sleep(self.check_interval)
+                await self._lead(conn)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Leader election: %s", e)
+            finally:
+                if conn is not None:
+                    # not close(): it waits for the server, which may be unreachable
+                    conn.terminate()
+            await asyncio.sleep(self.check_interval)
+
+    def stats(self):
+        return "leader" if self.is_leader else "follower"
+
+
+leader = LeaderElection(config.leader_lock_id, check_interval=config.leader_check_interval)
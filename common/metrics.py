@@ -0,0 +1,140 @@
+import logging
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from aiohttp import web
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOGLEVEL", logging.DEBUG))
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+registry = []
+_runner: web.AppRunner = None
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        """
+        Metric {name} in Prometheus text format, values are kept separately for every combination of {labels}.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('%s="%s"' % (name, _escape(value)) for name, value in pairs) + "}"
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s %s" % (self.name, self.type)]
+        lines.extend("%s%s %s" % (name, labels, repr(float(value))) for name, labels, value in self._samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._values = defaultdict(float)
+
+    def inc(self, value=1, **labels):
+        self._values[self._key(labels)] += value
+
+    def _samples(self):
+        for key, value in self._values.items():
+            yield self.name, self._format_labels(key), value
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # per labels: [count in every bucket (not cumulative) and +Inf, sum]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        if key not in self._values:
+            self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        counts, _ = self._values[key]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        self._values[key][1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        time_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - time_start, **labels)
+
+    def _samples(self):
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield self.name + "_bucket", self._format_labels(key, (("le", bound),)), cumulative
+            yield self.name + "_sum", self._format_labels(key), total
+            yield self.name + "_count", self._format_labels(key), cumulative
+
+
+def render():
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+async def handle_metrics(request):
+    return web.Response(body=render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+async def start_server(host, port):
+    global _runner
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    await web.TCPSite(_runner, host, port).start()
+
+    logger.info("Metrics are served on %s:%d/metrics", host, port)
+
+
+async def stop_server():
+    global _runner
+
+    if _runner is not None:
+        await _runner.cleanup()
+    _runner = None
@@ -0,0 +1,37 @@
+import asyncio
+
+from common import metrics
+
+single_flight_calls_total = metrics.Counter("single_flight_calls_total",
+                                            "Calls made (leader) and calls which joined an identical running one "
+                                            "(shared)", ("name", "result"))
+
+
+class SingleFlight:
+    def __init__(self, name):
+        """
+        Runs one call per key at a time: callers with the same key which come while it runs
+        wait for it and get the same result (or exception). {name} is used in metrics.
+        """
+        self.name = name
+        self._running = {}
+
+    def _forget(self, key, task):
+        if self._running.get(key) is task:
+            del self._running[key]
+        # the exception is marked as retrieved, even if every caller was cancelled
+        if not task.cancelled():
+            task.exception()
+
+    async def run(self, key, coroutine_function, *args):
+        task = self._running.get(key)
+        if task is None:
+            single_flight_calls_total.inc(name=self.name, result="leader")
+            task = asyncio.ensure_future(coroutine_function(*args))
+            self._running[key] = task
+            task.add_done_callback(lambda done_task: self._forget(key, done_task))
+        else:
+            single_flight_calls_total.inc(name=self.name, result="shared")
+
+        # a cancelled caller doesn't cancel the call for the others
+        return await asyncio.shield(task)
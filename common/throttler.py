@@ -1,21 +1,96 @@
 import asyncio
+import time
+from collections import OrderedDict
 
 
 class Throttler:
-    def __init__(self, interval=2):
+    def __init__(self, interval=2, max_chats=100000):
         """
-        Returns true (means throttled) if called more than one per {interval} seconds.
+        Returns true (means throttled) if called for the same chat more than once per {interval} seconds.
+        Remembers the last allowed call of not more than {max_chats} chats, the oldest are evicted first.
         """
         self.interval = interval
-        self.busy = False
+        self.max_chats = max_chats
+        self.allowed = 0
+        self.throttled = 0
+        self._chats_allowed_at = OrderedDict()
 
-    def __call__(self):
-        if not self.busy:
-            self.busy = True
-            asyncio.get_event_loop().call_later(self.interval, self.done)
-            return False
+    def __call__(self, chat_id):
+        now = time.monotonic()
+        allowed_at = self._chats_allowed_at.get(chat_id)
+        if allowed_at is not None and now - allowed_at < self.interval:
+            self.throttled += 1
+            return True
 
-        return True
+        self.allowed += 1
+        self._chats_allowed_at[chat_id] = now
+        self._chats_allowed_at.move_to_end(chat_id)
 
-    def done(self):
-        self.busy = False
+        # chats are ordered by the time of the last allowed call, so expired ones are at the beginning
+        while self._chats_allowed_at:
+            oldest_allowed_at = next(iter(self._chats_allowed_at.values()))
+            if now - oldest_allowed_at < self.interval and len(self._chats_allowed_at) <= self.max_chats:
+                break
+            self._chats_allowed_at.popitem(last=False)
+
+        return False
+
+    def stats(self):
+        return "chats: %d, allowed: %d, throttled: %d" % (len(self._chats_allowed_at), self.allowed, self.throttled)
+
+
+class TokenBucket:
+    def __init__(self, rate=25, capacity=None, chat_interval=1, max_chats=10000):
+        """
+        Waits in acquire() until a send is allowed: not more than {rate} sends per second in total
+        (bursts up to {capacity}) and not more than one send per {chat_interval} seconds to one chat.
+        pause() stops all sends, e.g. for "retry_after" seconds of Telegram flood control.
+        """
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.chat_interval = chat_interval
+        self.max_chats = max_chats
+
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0
+        self.acquired = 0
+
+        self._chats_next_send = {}
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, chat_id=None):
+        if chat_id is not None:
+            await self._acquire_chat(chat_id)
+
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.acquired += 1
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    async def _acquire_chat(self, chat_id):
+        now = time.monotonic()
+        if len(self._chats_next_send) >= self.max_chats:
+            self._chats_next_send = {chat: next_send for chat, next_send in self._chats_next_send.items()
+                                     if next_send > now}
+
+        next_send = max(now, self._chats_next_send.get(chat_id, 0))
+        self._chats_next_send[chat_id] = next_send + self.chat_interval
+        if next_send > now:
+            await asyncio.sleep(next_send - now)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.updated_at = self.paused_until
+        self.tokens = 0
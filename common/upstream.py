@@ -0,0 +1,221 @@
+import asyncio
+import logging
+import os
+import random
+import time
+
+import aiohttp
+
+import config
+from common import metrics
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOGLEVEL", logging.DEBUG))
+
+session: aiohttp.ClientSession = None
+
+upstream_request_seconds = metrics.Histogram("upstream_request_seconds",
+                                             "Time to response headers of checkege requests", ("endpoint",))
+upstream_responses_total = metrics.Counter("upstream_responses_total", "checkege responses by HTTP status",
+                                           ("endpoint", "status"))
+upstream_errors_total = metrics.Counter("upstream_errors_total", "checkege requests failed without a response",
+                                        ("endpoint", "error"))
+upstream_breaker_state = metrics.Gauge("upstream_breaker_state", "Circuit breaker state: 0 closed, 1 half-open, 2 open")
+upstream_breaker_opened_total = metrics.Counter("upstream_breaker_opened_total", "Times the circuit breaker opened")
+upstream_rejected_total = metrics.Counter("upstream_rejected_total", "Calls failed fast by the open circuit breaker")
+upstream_retries_total = metrics.Counter("upstream_retries_total", "Retried checkege calls")
+upstream_retries_denied_total = metrics.Counter("upstream_retries_denied_total",
+                                                "Retries not made because the retry budget was exhausted")
+
+# failures worth retrying: no response, a broken or not json body, a json without expected fields
+RETRYABLE_ERRORS = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, aiohttp.ContentTypeError,
+                    asyncio.TimeoutError, KeyError, ValueError)
+
+
+class UpstreamUnavailable(Exception):
+    """
+    checkege didn't answer: the circuit breaker is open or all attempts failed.
+    """
+
+
+class CircuitOpen(UpstreamUnavailable):
+    """
+    The call was not made at all because the circuit breaker is open.
+    """
+
+
+class UpstreamResponseError(Exception):
+    def __init__(self, status):
+        """
+        checkege answered with not successful HTTP {status}, such responses are not retried.
+        """
+        super().__init__("HTTP %d" % status)
+        self.status = status
+
+
+class CircuitBreaker:
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+    def __init__(self, failure_threshold=20, reset_timeout=10):
+        """
+        Opens after {failure_threshold} failures in a row: calls fail fast without requests to upstream.
+        Every {reset_timeout} seconds one trial call is let through, its success closes the breaker.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        upstream_breaker_state.set(self.state)
+
+    def _set_state(self, state):
+        self.state = state
+        upstream_breaker_state.set(state)
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at >= self.reset_timeout:
+            # the next trial is possible only after another timeout, even if this one never finishes
+            self.opened_at = now
+            self._set_state(self.HALF_OPEN)
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        if self.state != self.CLOSED:
+            logger.warning("Upstream: circuit breaker is closed")
+            self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+            if self.state == self.CLOSED:
+                logger.warning("Upstream: circuit breaker is open after %d failures", self.failures)
+                upstream_breaker_opened_total.inc()
+            self.opened_at = time.monotonic()
+            self._set_state(self.OPEN)
+
+
+class RetryBudget:
+    def __init__(self, ratio=0.2, min_per_second=5, capacity=100):
+        """
+        Allows retries in amount of {ratio} of calls, plus {min_per_second} retries per second when calls are rare,
+        so retries can't multiply load on an overloaded upstream. Not more than {capacity} retries are saved up.
+        """
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, tokens):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + tokens + (now - self.updated_at) * self.min_per_second)
+        self.updated_at = now
+
+    def on_call(self):
+        self._refill(self.ratio)
+
+    def try_retry(self):
+        self._refill(0)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+def backoff_delay(attempt, base=0.2, cap=2):
+    # "full jitter": random delays spread retries of many users over time instead of synchronous waves
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+breaker = CircuitBreaker(failure_threshold=config.upstream_breaker_threshold,
+                         reset_timeout=config.upstream_breaker_reset_timeout)
+retry_budget = RetryBudget(ratio=config.upstream_retry_ratio, min_per_second=config.upstream_retry_min_per_second)
+
+
+async def call(request, attempts=config.upstream_attempts):
+    """
+    Runs {request}() (a coroutine function making one checkege request) with up to {attempts} attempts,
+    exponential backoff with jitter between them, the shared retry budget and circuit breaker.
+    Raises UpstreamUnavailable if no attempt succeeded, UpstreamResponseError is passed through.
+    """
+    if not breaker.allow():
+        upstream_rejected_total.inc()
+        raise CircuitOpen("circuit breaker is open")
+    retry_budget.on_call()
+
+    for attempt in range(attempts):
+        try:
+            result = await request()
+        except UpstreamResponseError as e:
+            if e.status >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            raise
+        except RETRYABLE_ERRORS as e:
+            breaker.record_failure()
+            if attempt + 1 == attempts or breaker.state == breaker.OPEN:
+                raise UpstreamUnavailable(repr(e)) from e
+            if not retry_budget.try_retry():
+                upstream_retries_denied_total.inc()
+                raise UpstreamUnavailable(repr(e)) from e
+            upstream_retries_total.inc()
+            await asyncio.sleep(backoff_delay(attempt))
+        else:
+            breaker.record_success()
+            return result
+
+
+async def _on_request_start(session, context, params):
+    context.time_start = asyncio.get_running_loop().time()
+
+
+async def _on_request_end(session, context, params):
+    endpoint = params.url.path
+    upstream_request_seconds.observe(asyncio.get_running_loop().time() - context.time_start, endpoint=endpoint)
+    upstream_responses_total.inc(endpoint=endpoint, status=params.response.status)
+
+
+async def _on_request_exception(session, context, params):
+    endpoint = params.url.path
+    upstream_request_seconds.observe(asyncio.get_running_loop().time() - context.time_start, endpoint=endpoint)
+    upstream_errors_total.inc(endpoint=endpoint, error=type(params.exception).__name__)
+
+
+def create_upstream_session():
+    connector = aiohttp.TCPConnector(ssl=False,
+                                     limit=config.upstream_pool_size,
+                                     limit_per_host=config.upstream_pool_size_per_host,
+                                     ttl_dns_cache=config.upstream_dns_ttl,
+                                     use_dns_cache=True,
+                                     keepalive_timeout=config.upstream_keepalive_timeout)
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(_on_request_start)
+    trace_config.on_request_end.append(_on_request_end)
+    trace_config.on_request_exception.append(_on_request_exception)
+    return aiohttp.ClientSession(connector=connector, trace_configs=[trace_config])
+
+
+async def init_upstream():
+    global session
+
+    if session is None or session.closed:
+        session = create_upstream_session()
+
+    logger.info("Upstream session was initialized successfully.")
+
+
+async def close_upstream():
+    global session
+
+    if session is not None and not session.closed:
+        await session.close()
+    session = None
+
+    logger.info("Upstream session was closed.")
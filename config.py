@@ -4,11 +4,35 @@ API_TOKEN = os.environ.get("TG_API_TOKEN")
 NOTIFY_TIME = 0
 VERSION_BUILD = "3.2.4_02062024"
 
+# bot replicas behind the webhook: they don't share the users cache, its TTL is tuned by this
+replicas = int(os.environ.get("BOT_REPLICAS", 1))
+
 relax_timer = 5
-relax_mailer = 0.2
-relax_retry_error = 10
+# one results request of a chat per throttle_interval on each replica: with several replicas a chat may get
+# up to one per replica, a throttled request is dropped without an answer, so the interval is not stretched
+throttle_interval = 2
+throttle_max_chats = 100000
 relax_checker = 0.2
 
+# auto_checker requests to checkege: per second in total and at once
+checker_rate_limit = 10
+checker_concurrency = 10
+checker_samples_per_exam = 2
+
+# Telegram allows ~30 messages per second in total and ~1 message per second to one chat
+mailer_rate_limit = 25
+mailer_chat_interval = 1
+mailer_workers = 25
+mailer_attempts = 5
+mailer_report_interval = 30
+
+# broadcasts are stored in the outbox table: jobs are taken in batches and locked for outbox_lease seconds,
+# the lease is renewed while the batch is being sent, jobs of a crashed mailer are taken again after it expires
+outbox_batch = 50
+outbox_lease = 10
+outbox_poll_interval = 1
+outbox_consumers = 2
+
 admin_ids = list(os.environ.get("ADMIN_CHAT_IDS").split(","))
 db_url = os.environ.get("DATABASE_URL")
 
@@ -17,10 +41,16 @@ db_table_login = "login"
 db_table_regions = "regions"
 db_table_examsinfo = "exams_info"
 db_table_stats = "stats"
+db_table_counters = "counters"
+db_table_broadcasts = "broadcasts"
+db_table_outbox = "outbox"
+db_table_results = "results"
 
-EGE_URL = "https://checkege.rustest.ru/api/exam"
-EGE_TOKEN_URL = "https://checkege.rustest.ru/api/captcha"
-EGE_LOGIN_URL = "https://checkege.rustest.ru/api/participant/login"
+# EGE_BASE_URL may point to a stand-in server (see benchmarks/fake_checkege.py)
+EGE_BASE_URL = os.environ.get("EGE_BASE_URL", "https://checkege.rustest.ru")
+EGE_URL = EGE_BASE_URL + "/api/exam"
+EGE_TOKEN_URL = EGE_BASE_URL + "/api/captcha"
+EGE_LOGIN_URL = EGE_BASE_URL + "/api/participant/login"
 
 EGE_HEADERS = {
     'Accept': '*/*',
@@ -36,5 +66,46 @@ EGE_HEADERS = {
     'X-Requested-With': 'XMLHttpRequest'
 }
 
+counters_flush_interval = 5
+
+users_cache_size = 50000
+# other replicas see a logout or a new login up to users_cache_ttl seconds late, so it is short with several of them
+users_cache_ttl = 10 if replicas == 1 else 1
+
+render_cache_size = 10000
+render_cache_ttl = 600
+rendered_messages_size = 100000
+
+# the last results of a user are shown again without a checkege request for this long, unless refresh is forced
+results_cache_ttl = 30
+
+upstream_pool_size = 100
+upstream_pool_size_per_host = 50
+upstream_dns_ttl = 600
+upstream_keepalive_timeout = 60
+# checkege calls: attempts with backoff, retries allowed in addition to calls (as a share and per second),
+# failures in a row which open the circuit breaker and seconds before a trial call
+upstream_attempts = 5
+upstream_retry_ratio = 0.2
+upstream_retry_min_per_second = 5
+upstream_breaker_threshold = 20
+upstream_breaker_reset_timeout = 10
+
+# only one of the bot replicas (the holder of this advisory lock) runs the checker and broadcasts
+leader_lock_id = 7_351_201
+leader_check_interval = 5
+
+# webhook mode is used instead of long polling if WEBHOOK_URL (public https address of the bot) is set
+webhook_url = os.environ.get("WEBHOOK_URL")
+webhook_path = os.environ.get("WEBHOOK_PATH", "/webhook")
+webhook_secret = os.environ.get("WEBHOOK_SECRET")
+webhook_max_connections = 100
+webapp_host = os.environ.get("WEBAPP_HOST", "0.0.0.0")
+webapp_port = int(os.environ.get("WEBAPP_PORT", 8080))
+
+# Prometheus metrics are served on metrics_host:metrics_port/metrics, METRICS_PORT=0 disables them
+metrics_host = os.environ.get("METRICS_HOST", "0.0.0.0")
+metrics_port = int(os.environ.get("METRICS_PORT", 9100))
+
 proxy_url = os.environ.get("PROXY_URL")
 environment_id = os.environ.get("ENVIRONMENT_UID")
@@ -1,62 +1,234 @@
 import asyncio
 import logging
 import os
-import utils
 
 from datetime import datetime
 from aiogram import types, exceptions
-from config import relax_mailer, relax_retry_error
+from common import db, metrics
+from common.throttler import TokenBucket
+from config import mailer_rate_limit, mailer_chat_interval, mailer_workers, mailer_attempts, mailer_report_interval, \
+    outbox_batch, outbox_lease, outbox_poll_interval, outbox_consumers, \
+    db_table_users, db_table_regions, db_table_broadcasts, db_table_outbox
 
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOGLEVEL", logging.DEBUG))
 
-class Mailer:
-    def __init__(self, region, title, exam_id, bot, except_from_id=1):
-        logging.basicConfig()
-        self.logger = logging.getLogger("mailer_{}_{}".format(region, exam_id))
-        self.logger.setLevel(os.environ.get("LOGLEVEL", logging.DEBUG))
+# shared by all outbox consumers, so parallel broadcasts together stay within Telegram limits
+broadcast_bucket = TokenBucket(rate=mailer_rate_limit, chat_interval=mailer_chat_interval)
 
-        self.region = region
-        self.title = title
-        self.exam_id = exam_id
-        self.except_chat_id = except_from_id
-        self.bot = bot
+mailer_notifications_total = metrics.Counter("mailer_notifications_total", "Processed outbox jobs", ("result",))
+mailer_outbox_jobs = metrics.Gauge("mailer_outbox_jobs", "Notifications waiting in the outbox")
+mailer_active_broadcasts = metrics.Gauge("mailer_active_broadcasts", "Broadcasts not finished yet")
 
-    def run(self):
-        loop = asyncio.get_event_loop()
-        loop.create_task(self._mailer())
 
-    async def _send_message(self, chat_id, attempts=5):
+def _now():
+    return int(datetime.now().timestamp())
+
+
+async def enqueue_broadcast(region, exam_id, title, except_from_id=1):
+    """
+    Marks {exam_id} as notified in {region} and puts a notification for every subscribed user into the outbox,
+    in one transaction. Returns False if the broadcast was already enqueued by someone else.
+    """
+    broadcast_id = "%d:%d" % (region, exam_id)
+    async with db.conn_pool.acquire() as conn:
+        async with conn.transaction():
+            claimed = await conn.fetchval(
+                "update {regions} set notified_exams = array_append(notified_exams, $2) "
+                "where region = $1 and not $2 = any(notified_exams) returning region".format(regions=db_table_regions),
+                region, exam_id)
+            if claimed is None:
+                return False
+
+            status = await conn.execute(
+                "insert into {outbox} (broadcast_id, chat_id) select $1, chat_id from {users} "
+                "where exams @> array[$2::int] and region = $3 and chat_id <> $4 and notify = 1".format(
+                    outbox=db_table_outbox, users=db_table_users),
+                broadcast_id, exam_id, region, except_from_id)
+            users_count = int(status.split()[-1])
+
+            await conn.execute(
+                "insert into {broadcasts} (id, region, exam_id, title, users_count, created_at) "
+                "values ($1, $2, $3, $4, $5, $6) on conflict (id) do update set "
+                "title = excluded.title, users_count = excluded.users_count, sent_count = 0, failed_count = 0, "
+                "created_at = excluded.created_at, finished_at = null".format(broadcasts=db_table_broadcasts),
+                broadcast_id, region, exam_id, title, users_count, _now())
+
+    logger.warning("MAILER ENQUEUED %d %s %d users", region, title, users_count)
+    return True
+
+
+class Outbox:
+    def __init__(self, batch_size=50, lease=10, poll_interval=1, consumers=2):
+        """
+        Sends notifications stored in the outbox table. Every one of {consumers} takes up to {batch_size} jobs,
+        sends them and deletes sent ones in one transaction. Taken jobs are hidden from others for {lease} seconds
+        (renewed while they are sent), so jobs of a crashed process are sent again soon by another replica,
+        at most one batch twice. A stopped consumer records sent jobs and releases the rest at once.
+        """
+        self.batch_size = batch_size
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.consumers = consumers
+
+    async def _take_jobs(self):
+        return await db.outbox_table.custom_fetch(
+            "update {outbox} o set locked_until = extract(epoch from now())::int + $2 from {broadcasts} b "
+            "where o.id in (select id from {outbox} where locked_until <= extract(epoch from now())::int "
+            "               order by id limit $1 for update skip locked) "
+            "and b.id = o.broadcast_id "
+            "returning o.id, o.broadcast_id, o.chat_id, b.title".format(outbox=db_table_outbox,
+                                                                        broadcasts=db_table_broadcasts),
+            self.batch_size, self.lease)
+
+    async def _complete_jobs(self, jobs, results):
+        progress = {}
+        for job, sent in zip(jobs, results):
+            sent_count, failed_count = progress.get(job["broadcast_id"], (0, 0))
+            progress[job["broadcast_id"]] = (sent_count + 1, failed_count) if sent is True \
+                else (sent_count, failed_count + 1)
+
+        sent_total = sum(sent_count for sent_count, _ in progress.values())
+        mailer_notifications_total.inc(sent_total, result="sent")
+        mailer_notifications_total.inc(len(jobs) - sent_total, result="failed")
+
+        async with db.conn_pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("delete from %s where id = any($1)" % db_table_outbox, [job["id"] for job in jobs])
+                await conn.executemany(
+                    "update %s set sent_count = sent_count + $2, failed_count = failed_count + $3 "
+                    "where id = $1" % db_table_broadcasts,
+                    [(broadcast_id, sent_count, failed_count)
+                     for broadcast_id, (sent_count, failed_count) in progress.items()])
+
+    async def _renew_lease(self, jobs):
+        while True:
+            await asyncio.sleep(self.lease / 2)
+            await db.outbox_table.custom_fetch(
+                "update %s set locked_until = extract(epoch from now())::int + $2 where id = any($1)" % db_table_outbox,
+                [job["id"] for job in jobs], self.lease)
+
+    async def _interrupt_jobs(self, jobs, sends=()):
+        """
+        Called when a consumer is cancelled: records finished {sends} of {jobs},
+        the rest (not sent or cancelled in the middle of sending) are released for the next leader at once.
+        """
+        try:
+            finished = [(job, send) for job, send in zip(jobs, sends) if send.done() and not send.cancelled()]
+            if finished:
+                await self._complete_jobs([job for job, _ in finished],
+                                          [send.exception() or send.result() for _, send in finished])
+
+            finished_ids = {job["id"] for job, _ in finished}
+            await db.outbox_table.custom_fetch(
+                "update %s set locked_until = 0 where id = any($1)" % db_table_outbox,
+                [job["id"] for job in jobs if job["id"] not in finished_ids])
+        except Exception as e:
+            logger.warning("Outbox: interrupted jobs were not released: %s", e)
+
+    async def _send_message(self, bot, chat_id, title):
         markup_button = types.InlineKeyboardButton("Обновить результаты", callback_data="results_update")
         markup = types.InlineKeyboardMarkup().add(markup_button)
-        message = "⚡️*Доступны результаты по предмету %s*⚡️\nОбновите, чтобы узнать баллы:" % self.title.upper()
+        message = "⚡️*Доступны результаты по предмету %s*⚡️\nОбновите, чтобы узнать баллы:" % title.upper()
+
+        for attempt in range(mailer_attempts):
+            await broadcast_bucket.acquire(chat_id)
+            try:
+                await bot.send_message(chat_id, message, parse_mode="MARKDOWN", reply_markup=markup)
+                return True
+            except exceptions.RetryAfter as e:
+                logger.warning("User: %d RetryAfter error, waiting for %d secs..." % (chat_id, e.timeout))
+                broadcast_bucket.pause(e.timeout)
+            except exceptions.BotBlocked:
+                logger.warning("User: %d blocked a bot while notifying" % chat_id)
+                return False
+            except Exception as e:
+                logger.warning("User: %d unexpected error while notifying: %s", chat_id, e)
+                return False
+
+        return False
+
+    async def _consumer(self, bot, semaphore):
+        async def send(job):
+            async with semaphore:
+                return await self._send_message(bot, job["chat_id"], job["title"])
+
+        while True:
+            try:
+                taking = asyncio.ensure_future(self._take_jobs())
+                try:
+                    jobs = await asyncio.shield(taking)
+                except asyncio.CancelledError:
+                    # the jobs may be already leased in the database
+                    await asyncio.wait([taking])
+                    if not taking.cancelled() and not taking.exception():
+                        await asyncio.shield(self._interrupt_jobs(taking.result()))
+                    raise
+                if not jobs:
+                    await asyncio.sleep(self.poll_interval)
+                    continue
 
+                sends = [asyncio.ensure_future(send(job)) for job in jobs]
+                lease_renewal = asyncio.ensure_future(self._renew_lease(jobs))
+                try:
+                    results = await asyncio.gather(*sends, return_exceptions=True)
+                except asyncio.CancelledError:
+                    # the leadership is lost or the bot stops: sent jobs must not be sent again
+                    for send_task in sends:
+                        send_task.cancel()
+                    await asyncio.gather(*sends, return_exceptions=True)
+                    await asyncio.shield(self._interrupt_jobs(jobs, sends))
+                    raise
+                finally:
+                    lease_renewal.cancel()
+                await self._complete_jobs(jobs, results)
+            except Exception as e:
+                logger.warning("Outbox: an unexpected error happened: %s", e)
+                await asyncio.sleep(self.poll_interval)
+
+    async def _report(self):
+        now = _now()
+        rows = await db.broadcasts_table.custom_fetch(
+            "update {broadcasts} b set finished_at = $1 where finished_at is null "
+            "and not exists (select 1 from {outbox} o where o.broadcast_id = b.id) returning *".format(
+                broadcasts=db_table_broadcasts, outbox=db_table_outbox), now)
+        for row in rows:
+            total_time = now - row["created_at"]
+            logger.warning("MAILER FINISHED %d %s %d users (%d sent, %d failed), in %d secs, %.1f sends/sec",
+                           row["region"], row["title"], row["users_count"], row["sent_count"], row["failed_count"],
+                           total_time, row["sent_count"] / total_time if total_time > 0 else 0)
+
+        rows = await db.broadcasts_table.custom_fetch(
+            "select * from %s where finished_at is null" % db_table_broadcasts)
+        mailer_active_broadcasts.set(len(rows))
+        mailer_outbox_jobs.set(await db.outbox_table.count())
+        for row in rows:
+            total_time = now - row["created_at"]
+            logger.info("MAILER PROGRESS %d %s %d/%d users (%d failed), %.1f sends/sec",
+                        row["region"], row["title"], row["sent_count"], row["users_count"], row["failed_count"],
+                        row["sent_count"] / total_time if total_time > 0 else 0)
+
+    async def _reporter(self):
+        while True:
+            await asyncio.sleep(mailer_report_interval)
+            try:
+                await self._report()
+            except Exception as e:
+                logger.warning("Outbox: report failed: %s", e)
+
+    async def run(self, bot):
+        semaphore = asyncio.Semaphore(mailer_workers)
+        tasks = [asyncio.create_task(self._reporter())] + \
+                [asyncio.create_task(self._consumer(bot, semaphore)) for _ in range(self.consumers)]
         try:
-            await self.bot.send_message(chat_id, message, parse_mode="MARKDOWN", reply_markup=markup)
-        except exceptions.RetryAfter:
-            self.logger.warning("User: %d RetryAfter error, waiting..." % chat_id)
-            await asyncio.sleep(relax_retry_error)
-            if attempts > 0:
-                await self._send_message(chat_id, attempts-1)
-        except exceptions.BotBlocked:
-            self.logger.warning("User: %d blocked a bot while notifying" % chat_id)
-        except Exception as e:
-            self.logger.warning("User: %d unexpected error while notifying: %s", chat_id, e)
-
-    async def _mailer(self):
-        self.logger.warning("MAILER STARTED %d %s" % (self.region, self.title))
-        time_start = datetime.now().timestamp()
-        users_count = 0
-        users_fetched = await utils.users_table.custom_fetch(
-            "select * from users where $1 = any(exams) and region = $2 and chat_id <> $3 and notify = 1",
-            self.exam_id,
-            self.region,
-            self.except_chat_id)
-
-        for user in users_fetched:
-            chat_id = user["chat_id"]
-            users_count += 1
-            await self._send_message(chat_id)
-            await asyncio.sleep(relax_mailer)
-
-        total_time = datetime.now().timestamp() - time_start
-        self.logger.warning("MAILER FINISHED %d %s %d users, in %f secs\n",
-                            self.region, self.title, users_count, total_time)
+            await asyncio.gather(*tasks)
+        finally:
+            # consumers record and release their jobs before the outbox is stopped
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+outbox = Outbox(batch_size=outbox_batch, lease=outbox_lease, poll_interval=outbox_poll_interval,
+                consumers=outbox_consumers)
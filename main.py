@@ -1,4 +1,5 @@
 import asyncio
+import inspect
 import logging
 import auto_checker
 import config
@@ -6,23 +7,57 @@ import os
 import utils
 
 from aiogram import Bot, Dispatcher, executor, types
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.dispatcher.webhook import WebhookRequestHandler
+from aiohttp import web
 from aiogram.utils.exceptions import MessageNotModified, MessageTextIsEmpty, InvalidQueryID, RetryAfter, \
     MessageIdInvalid, MessageToEditNotFound
-from common import strings, buttons, db
+from common import strings, buttons, db, upstream, metrics
+from common.counters import counters
+from common.leader import leader
+from mailer import outbox
+from io import BytesIO
+from functools import lru_cache
 from random import choice
 
+from common.cache import TTLCache
 from common.throttler import Throttler
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(os.environ.get("LOGLEVEL", logging.DEBUG))
 
+telegram_request_seconds = metrics.Histogram("telegram_request_seconds", "Time of Bot API requests", ("method",))
+telegram_errors_total = metrics.Counter("telegram_errors_total", "Failed Bot API requests", ("method", "error"))
+telegram_retry_after_seconds_total = metrics.Counter("telegram_retry_after_seconds_total",
+                                                     "Waiting time requested by RetryAfter errors", ("method",))
+
+
+class MeasuredBot(Bot):
+    async def request(self, method, data=None, files=None, **kwargs):
+        with telegram_request_seconds.time(method=method):
+            try:
+                return await super().request(method, data, files, **kwargs)
+            except RetryAfter as e:
+                telegram_errors_total.inc(method=method, error="RetryAfter")
+                telegram_retry_after_seconds_total.inc(e.timeout, method=method)
+                raise
+            except Exception as e:
+                telegram_errors_total.inc(method=method, error=type(e).__name__)
+                raise
+
+
 # Initialize bot and dispatcher
-bot = Bot(token=config.API_TOKEN)
+bot = MeasuredBot(token=config.API_TOKEN)
 dp = Dispatcher(bot)
 
 relax = False
-throttled_by_id = {}
+allowed_updates = types.AllowedUpdates.MESSAGE + types.AllowedUpdates.CALLBACK_QUERY
+background_tasks = []
+throttler = Throttler(interval=config.throttle_interval, max_chats=config.throttle_max_chats)
+# hash of the last text rendered into each (chat_id, message_id), to skip edits which change nothing
+rendered_messages = TTLCache(max_size=config.rendered_messages_size, ttl=60 * 60 * 24)
 
 
 class OneEventLoopPolicy(asyncio.DefaultEventLoopPolicy):
@@ -36,15 +71,85 @@ class OneEventLoopPolicy(asyncio.DefaultEventLoopPolicy):
         return self._loop
 
 
+@lru_cache(maxsize=None)
+def handler_takes_user_context(handler):
+    return "user_context" in inspect.signature(handler).parameters
+
+
+class UserContextMiddleware(BaseMiddleware):
+    """
+    Loads user and login state of the chat once per update, handlers get it as "user_context" argument.
+    Handlers without this argument (help, regions list, stickers...) don't make any query.
+    """
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        if handler_takes_user_context(current_handler.get()):
+            data["user_context"] = await utils.user_load_context(message.chat.id)
+
+    async def on_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        if handler_takes_user_context(current_handler.get()):
+            data["user_context"] = await utils.user_load_context(callback_query.message.chat.id)
+
+
+dp.middleware.setup(UserContextMiddleware())
+
+
+class SecretWebhookRequestHandler(WebhookRequestHandler):
+    """
+    Accepts only updates with the secret token given to Telegram in set_webhook (if it is configured).
+    """
+
+    async def post(self):
+        if config.webhook_secret and \
+                self.request.headers.get("X-Telegram-Bot-Api-Secret-Token") != config.webhook_secret:
+            raise web.HTTPUnauthorized()
+        return await super().post()
+
+
+async def on_startup(dispatcher: Dispatcher):
+    await db.init_db()
+    await upstream.init_upstream()
+
+    # updates queued while the bot was down are dropped, unless other replicas are serving and may be behind
+    drop_pending_updates = bool(config.webhook_url) and not await leader.has_leader()
+
+    # every replica serves users, only the elected one runs the checker and sends broadcasts
+    leader.add_task(auto_checker.check_thread_runner, bot)
+    leader.add_task(outbox.run, bot)
+    background_tasks.append(asyncio.create_task(leader.run()))
+    background_tasks.append(asyncio.create_task(counters.run()))
+
+    if config.metrics_port:
+        await metrics.start_server(config.metrics_host, config.metrics_port)
+
+    if config.webhook_url:
+        await bot.set_webhook(config.webhook_url + config.webhook_path,
+                              secret_token=config.webhook_secret,
+                              max_connections=config.webhook_max_connections,
+                              allowed_updates=allowed_updates,
+                              drop_pending_updates=drop_pending_updates)
+        logger.info("Webhook was set (pending updates %s), listening on %s:%d",
+                    "dropped" if drop_pending_updates else "kept", config.webapp_host, config.webapp_port)
+
+
+async def on_shutdown(dispatcher: Dispatcher):
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+
+    await metrics.stop_server()
+    await upstream.close_upstream()
+    await counters.close()
+
+
 # Captcha handler:
 async def bot_send_captcha(chat_id):
     await bot.send_message(chat_id, strings.login_captcha_prompt, parse_mode="MARKDOWN")
 
-    shelve_result = await utils.handle_captcha_get(chat_id)
-    if shelve_result:
-        with open("_captcha" + str(chat_id), "rb") as photo:
-            await bot.send_photo(chat_id, photo)
-        utils.handle_captcha_delete(chat_id)
+    captcha_image = await utils.handle_captcha_get(chat_id)
+    if captcha_image:
+        await bot.send_photo(chat_id, types.InputFile(BytesIO(captcha_image), filename="captcha.jpg"))
     else:
         markup_button = types.InlineKeyboardButton("Запросить капчу заново", callback_data="captcha_retry")
         markup = types.InlineKeyboardMarkup().add(markup_button)
@@ -54,32 +159,35 @@ async def bot_send_captcha(chat_id):
 
 
 # Results get handler:
-async def bot_send_results(chat_id, is_first_user_hash=False):
-    throttled_by_id.setdefault(chat_id, Throttler())
-    if throttled_by_id[chat_id]():
+async def bot_send_results(chat_id, is_first_user_hash=False, user_context=None, force=False):
+    if throttler(chat_id):
         logger.debug("%d throttled" % chat_id)
         return
 
-    if await utils.user_check_logged(chat_id):
+    user = await utils.user_check_logged(chat_id, user_context)
+    if user:
         try:
-            err_msg, response = await utils.handle_get_results_json(chat_id)
+            # the first results after the login are always requested from checkege
+            err_msg, response = await utils.handle_get_results_json(chat_id, user=user,
+                                                                    force=force or bool(is_first_user_hash))
 
             if err_msg:  # throws Error
                 text = err_msg
             elif response:  # else answer not null -> send response
-                updates = await utils.check_results_updates(chat_id, response, callback_bot=bot)
+                updates = await utils.check_results_updates(chat_id, response, callback_bot=bot, user=user)
                 text = await utils.parse_results_message(response, updates, is_first_user_hash)
             else:  # response is Null
                 text = "Пока результатов в вашем профиле нет.\nПопробуйте обновить позже."
 
-            region = await utils.user_get_region(chat_id)
+            region = await utils.user_get_region(chat_id, user)
             await send_notify_region_site(chat_id, region)
-            await bot.send_message(chat_id,
-                                   text,
-                                   parse_mode="MARKDOWN",
-                                   reply_markup=buttons.markup_inline_results())
+            message = await bot.send_message(chat_id,
+                                             text,
+                                             parse_mode="MARKDOWN",
+                                             reply_markup=buttons.markup_inline_results())
+            rendered_messages.set((chat_id, message.message_id), hash(text))
 
-            if is_first_user_hash:
+            if is_first_user_hash and response:
                 await utils.regions_update_exams(region, response)
                 await utils.examsinfo_update(response)
                 await utils.pass_stats_exams_by_user_hash(is_first_user_hash, response)
@@ -135,9 +243,9 @@ async def send_notify_region_site(chat_id, region):
 
 # Commands handlers:
 @dp.message_handler(commands=['start'])
-async def send_welcome(message: types.Message):
+async def send_welcome(message: types.Message, user_context: utils.UserContext):
     logger.debug(message.chat.id)
-    shelve_result = await utils.user_check_logged(int(message.chat.id))
+    shelve_result = await utils.user_check_logged(int(message.chat.id), user_context)
     if not relax:
         if shelve_result:
             await message.answer(strings.start_authed)
@@ -154,8 +262,9 @@ async def clear_request(message: types.Message):
 
 
 @dp.message_handler(commands=['check'])
-async def check_request(message: types.Message):
-    await bot_send_results(message.chat.id)
+async def check_request(message: types.Message, user_context: utils.UserContext):
+    # an explicit command bypasses the saved results
+    await bot_send_results(message.chat.id, user_context=user_context, force=True)
 
 
 @dp.message_handler(commands=['version'])
@@ -167,43 +276,51 @@ async def check_request(message: types.Message):
 @dp.message_handler(commands=['stats'])
 async def check_request(message: types.Message):
     if str(message.chat.id) in config.admin_ids:
-        await message.answer(await utils.table_count())
+        await message.answer(await utils.table_count() + "\nThrottler: " + throttler.stats() +
+                             "\nReplica: " + leader.stats())
 
 
 # Button callbacks:
 @dp.callback_query_handler(lambda c: c.data == 'results_update')
-async def process_callback_results_update(callback_query: types.CallbackQuery):
+async def process_callback_results_update(callback_query: types.CallbackQuery, user_context: utils.UserContext):
     chat_id = callback_query.message.chat.id
     text = ""
     callback_text = ""
 
-    throttled_by_id.setdefault(chat_id, Throttler())
-    if throttled_by_id[chat_id]():
+    if throttler(chat_id):
         logger.debug("%d throttled" % chat_id)
         await bot.answer_callback_query(callback_query.id)
         return
 
     try:
-        if await utils.user_check_logged(chat_id):
-            err_msg, response = await utils.handle_get_results_json(chat_id)
+        user = await utils.user_check_logged(chat_id, user_context)
+        if user:
+            err_msg, response = await utils.handle_get_results_json(chat_id, user=user)
             if err_msg:  # throws Error
                 text = err_msg
             elif response:  # else answer not null -> send response
-                updates = await utils.check_results_updates(chat_id, response, callback_bot=bot)
+                updates = await utils.check_results_updates(chat_id, response, callback_bot=bot, user=user)
                 text = await utils.parse_results_message(response, updates)
                 if not updates:
                     callback_text = "Обновлений нет"
             else:  # response is Null
                 text = "Пока результатов в вашем профиле нет.\nПопробуйте обновить позже."
 
+        message_key = (chat_id, callback_query.message.message_id)
+        if text and rendered_messages.get(message_key, None) == hash(text):  # nothing to edit
+            await bot.answer_callback_query(callback_query.id, text=callback_text)
+            return
+
         await bot.edit_message_text(chat_id=callback_query.message.chat.id,
                                     message_id=callback_query.message.message_id,
                                     text=text,
                                     parse_mode="MARKDOWN",
                                     reply_markup=buttons.markup_inline_results())
+        rendered_messages.set(message_key, hash(text))
         await bot.answer_callback_query(callback_query.id, text=callback_text)
 
     except MessageNotModified:
+        rendered_messages.set((chat_id, callback_query.message.message_id), hash(text))
         await bot.answer_callback_query(callback_query.id, text=callback_text)
     except MessageTextIsEmpty:
         pass
@@ -263,9 +380,9 @@ async def process_callback_regions_hide(callback_query: types.CallbackQuery):
 
 
 @dp.callback_query_handler(lambda c: c.data == 'captcha_retry')
-async def process_callback_captcha_again(callback_query: types.CallbackQuery):
+async def process_callback_captcha_again(callback_query: types.CallbackQuery, user_context: utils.UserContext):
     await bot.answer_callback_query(callback_query.id)
-    if await utils.user_get_login_status(callback_query.message.chat.id) == "captcha":
+    if await utils.user_get_login_status(callback_query.message.chat.id, user_context) == "captcha":
         await bot_send_captcha(callback_query.message.chat.id)
 
 
@@ -286,8 +403,8 @@ async def process_callback_start_over(callback_query: types.CallbackQuery):
 
 # Regexp handlers:
 @dp.message_handler(regexp='Авторизоваться ➡️')
-async def btn_login_start(message: types.Message):
-    shelve_result = await utils.user_check_logged(int(message.chat.id))
+async def btn_login_start(message: types.Message, user_context: utils.UserContext):
+    shelve_result = await utils.user_check_logged(int(message.chat.id), user_context)
     if not relax:
         if shelve_result:
             await message.answer(strings.start_authed)
@@ -309,9 +426,9 @@ async def btn_timetable(message: types.Message):
 
 
 @dp.message_handler(regexp='Получить результаты 🔄')
-async def btn_results(message: types.Message):
-    if await utils.user_check_logged(message.chat.id):
-        await bot_send_results(message.chat.id)
+async def btn_results(message: types.Message, user_context: utils.UserContext):
+    if await utils.user_check_logged(message.chat.id, user_context):
+        await bot_send_results(message.chat.id, user_context=user_context)
 
 
 @dp.message_handler(regexp='Выйти')
@@ -346,16 +463,16 @@ async def sticker_answer(message: types.Message):
                 'CAACAgIAAxkBAAEP-axij1RxuV6WmfbixVXdsSHHBG4ppwAClgsAAgGxSUrXP-UOB9uGfyQE']
 
     if message.sticker.file_unique_id == 'AgADfhAAAowt_Qc':
-        await utils.stats_table.collect_sticker_feature(message.sticker.file_unique_id)
+        counters.add("sticker:" + message.sticker.file_unique_id)
     if not relax:
         await bot.send_sticker(message.chat.id, sticker=choice(stickers))
 
 
 @dp.message_handler()
-async def echo(message: types.Message):
+async def echo(message: types.Message, user_context: utils.UserContext):
     text = message.text
     chat_id = message.chat.id
-    status = await utils.user_get_login_status(chat_id)
+    status = await utils.user_get_login_status(chat_id, user_context)
 
     if status == '_name':
         shelve_result = await utils.user_login_set_name(chat_id, text)
@@ -407,11 +524,17 @@ async def echo(message: types.Message):
 
 if __name__ == '__main__':
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(db.init_db())
-
-    loop.create_task(auto_checker.check_thread_runner(bot))
-
     asyncio.set_event_loop_policy(OneEventLoopPolicy(loop))
 
-    executor.start_polling(dp, skip_updates=True,
-                           allowed_updates=types.AllowedUpdates.MESSAGE + types.AllowedUpdates.CALLBACK_QUERY)
+    # pending updates are dropped in set_webhook (if no other replica runs), in polling mode they are skipped
+    bot_executor = executor.Executor(dp, skip_updates=not config.webhook_url, loop=loop)
+    bot_executor.on_startup(on_startup)
+    bot_executor.on_shutdown(on_shutdown)
+
+    if config.webhook_url:
+        bot_executor.start_webhook(config.webhook_path,
+                                   request_handler=SecretWebhookRequestHandler,
+                                   host=config.webapp_host,
+                                   port=config.webapp_port)
+    else:
+        bot_executor.start_polling(allowed_updates=allowed_updates)
@@ -0,0 +1,7 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# config reads them on import
+os.environ.setdefault("ADMIN_CHAT_IDS", "")
+os.environ.setdefault("TG_API_TOKEN", "123456:test")
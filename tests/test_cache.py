@@ -0,0 +1,93 @@
+import pytest
+
+from common import cache
+from common.cache import TTLCache, MISSING
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, "monotonic", clock)
+    return clock
+
+
+def test_get_set_and_expiry(clock):
+    c = TTLCache(max_size=10, ttl=5)
+    assert c.get(1) is MISSING
+    c.set(1, "row")
+    assert c.get(1) == "row"
+
+    clock.now += 5
+    assert c.get(1, None) is None
+    assert len(c) == 0
+    assert (c.hits, c.misses) == (1, 2)
+
+
+def test_lru_eviction(clock):
+    c = TTLCache(max_size=2, ttl=5)
+    c.set(1, "a")
+    c.set(2, "b")
+    c.get(1)
+    c.set(3, "c")
+    assert c.get(2, None) is None
+    assert c.get(1) == "a"
+    assert c.get(3) == "c"
+
+
+def test_negative_row_is_cached(clock):
+    c = TTLCache(max_size=10, ttl=5)
+    version = c.version(1)
+    c.set(1, None, version)
+    assert c.get(1, MISSING) is None
+    assert c.hits == 1
+
+
+def test_read_invalidated_during_it_is_not_stored(clock):
+    c = TTLCache(max_size=10, ttl=5)
+    c.set(1, "old")
+    version = c.version(1)
+    c.invalidate(1)
+    c.set(1, "old", version)
+    assert c.get(1, None) is None
+
+    # the next read sees the new version
+    version = c.version(1)
+    c.set(1, "new", version)
+    assert c.get(1) == "new"
+
+
+def test_write_of_another_key_does_not_reject_read(clock):
+    c = TTLCache(max_size=10, ttl=5)
+    version = c.version(1)
+    c.invalidate(2)
+    c.set(1, "row", version)
+    assert c.get(1) == "row"
+
+
+def test_forgotten_invalidation_bumps_epoch(clock):
+    c = TTLCache(max_size=2, ttl=5)
+    version = c.version(1)
+    for key in (10, 11, 12):  # the counter of 10 is evicted, reads in flight can't be checked anymore
+        c.invalidate(key)
+    c.set(1, "row", version)
+    assert c.get(1, None) is None
+
+    c.set(1, "row", c.version(1))
+    assert c.get(1) == "row"
+
+
+def test_clear_rejects_reads_in_flight(clock):
+    c = TTLCache(max_size=10, ttl=5)
+    c.set(2, "b")
+    version = c.version(1)
+    c.clear()
+    c.set(1, "row", version)
+    assert len(c) == 0
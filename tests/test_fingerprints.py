@@ -0,0 +1,34 @@
+from hashlib import md5
+
+import utils
+
+
+def exam(exam_id, mark=0, has_result=False):
+    return {"ExamId": exam_id, "TestMark": mark, "HasResult": has_result, "IsHidden": False,
+            "Status": 0, "AppealStatus": 0}
+
+
+def test_dump_and_load():
+    fingerprints = {2: "0000beef", 10: utils.exam_fingerprint(exam(10))}
+    exams_hash = utils.dump_exams_fingerprints(fingerprints)
+    assert exams_hash == "2:0000beef,10:%s" % fingerprints[10]
+    assert utils.load_exams_fingerprints(exams_hash) == fingerprints
+
+
+def test_load_empty_and_old_values():
+    assert utils.load_exams_fingerprints(None) == {}
+    assert utils.load_exams_fingerprints("") == {}
+    # before per-exam fingerprints 'exams_hash' was an md5 of the whole response, it is read as no fingerprints
+    assert utils.load_exams_fingerprints(md5(b"[]").hexdigest()) == {}
+    assert utils.load_exams_fingerprints("12345678901234567890123456789012") == {}
+
+
+def test_load_skips_broken_items():
+    assert utils.load_exams_fingerprints("1:aa,x:bb,3:,4:cc") == {1: "aa", 4: "cc"}
+
+
+def test_fingerprint_changes_only_with_results():
+    before = exam(1)
+    assert utils.exam_fingerprint(before) == utils.exam_fingerprint(dict(before, Subject="Математика"))
+    assert utils.exam_fingerprint(before) != utils.exam_fingerprint(exam(1, mark=70, has_result=True))
+    assert utils.exam_fingerprint(before) != utils.exam_fingerprint(dict(before, AppealStatus=1))
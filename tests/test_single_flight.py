@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+
+from common.single_flight import SingleFlight
+
+
+def test_concurrent_calls_share_one_run():
+    flight = SingleFlight("test")
+    calls = []
+
+    async def fetch(key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return "result %s" % key
+
+    async def main():
+        return await asyncio.gather(*(flight.run(key, fetch, key) for key in (1, 1, 1, 2)))
+
+    assert asyncio.run(main()) == ["result 1", "result 1", "result 1", "result 2"]
+    assert calls == [1, 2]
+    assert flight._running == {}
+
+
+def test_next_call_runs_again():
+    flight = SingleFlight("test")
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        return len(calls)
+
+    async def main():
+        return [await flight.run("key", fetch), await flight.run("key", fetch)]
+
+    assert asyncio.run(main()) == [1, 2]
+
+
+def test_exception_is_shared():
+    flight = SingleFlight("test")
+
+    async def fetch():
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream")
+
+    async def main():
+        return await asyncio.gather(flight.run("key", fetch), flight.run("key", fetch), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, ValueError) for result in results)
+    assert results[0] is results[1]
+
+
+def test_cancelled_caller_does_not_cancel_others():
+    flight = SingleFlight("test")
+
+    async def fetch():
+        await asyncio.sleep(0.05)
+        return "ok"
+
+    async def main():
+        first = asyncio.ensure_future(flight.run("key", fetch))
+        second = asyncio.ensure_future(flight.run("key", fetch))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(main()) == "ok"
@@ -0,0 +1,59 @@
+import pytest
+
+from common import throttler
+from common.throttler import Throttler
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(throttler.time, "monotonic", clock)
+    return clock
+
+
+def test_one_call_per_interval(clock):
+    t = Throttler(interval=2)
+    assert not t(1)
+    assert t(1)
+    assert not t(2)
+
+    clock.now += 1.9
+    assert t(1)
+    clock.now += 0.1
+    assert not t(1)
+    assert (t.allowed, t.throttled) == (3, 2)
+
+
+def test_throttled_call_does_not_extend_interval(clock):
+    t = Throttler(interval=2)
+    t(1)
+    clock.now += 1
+    assert t(1)
+    clock.now += 1
+    assert not t(1)
+
+
+def test_expired_chats_are_evicted(clock):
+    t = Throttler(interval=2)
+    for chat_id in range(100):
+        t(chat_id)
+    clock.now += 2
+    t(1000)
+    assert len(t._chats_allowed_at) == 1
+
+
+def test_oldest_chats_are_evicted_over_max_chats(clock):
+    t = Throttler(interval=2, max_chats=3)
+    for chat_id in range(5):
+        t(chat_id)
+    assert list(t._chats_allowed_at) == [2, 3, 4]
+    # the evicted chat is not throttled anymore
+    assert not t(0)
@@ -0,0 +1,138 @@
+import asyncio
+
+import pytest
+
+from common import upstream
+from common.upstream import CircuitBreaker, RetryBudget, CircuitOpen, UpstreamUnavailable, UpstreamResponseError
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(upstream.time, "monotonic", clock)
+    return clock
+
+
+def test_breaker_opens_after_threshold(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == breaker.CLOSED
+    breaker.record_success()
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == breaker.CLOSED  # failures must be in a row
+
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN
+    assert not breaker.allow()
+
+
+def test_breaker_lets_one_trial_per_timeout(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+    breaker.record_failure()
+
+    clock.now += 10
+    assert breaker.allow()
+    assert breaker.state == breaker.HALF_OPEN
+    assert not breaker.allow()
+
+    # a failed trial opens it again for another timeout
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN
+    clock.now += 9
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == breaker.CLOSED
+    assert breaker.allow()
+
+
+def test_retry_budget(clock):
+    budget = RetryBudget(ratio=0.5, min_per_second=1, capacity=2)
+    assert budget.try_retry()
+    assert budget.try_retry()
+    assert not budget.try_retry()
+
+    budget.on_call()
+    budget.on_call()
+    assert budget.try_retry()
+    assert not budget.try_retry()
+
+    clock.now += 1
+    assert budget.try_retry()
+    clock.now += 100  # not more than capacity is saved up
+    assert budget.try_retry()
+    assert budget.try_retry()
+    assert not budget.try_retry()
+
+
+@pytest.fixture
+def resilience(monkeypatch):
+    monkeypatch.setattr(upstream, "breaker", CircuitBreaker(failure_threshold=3, reset_timeout=10))
+    monkeypatch.setattr(upstream, "retry_budget", RetryBudget(ratio=0, min_per_second=0, capacity=100))
+    monkeypatch.setattr(upstream, "backoff_delay", lambda attempt: 0)
+
+
+def failing(errors, result="ok"):
+    errors = list(errors)
+    calls = []
+
+    async def request():
+        calls.append(1)
+        if errors:
+            raise errors.pop(0)
+        return result
+
+    return request, calls
+
+
+def test_call_retries_until_success(resilience):
+    request, calls = failing([asyncio.TimeoutError(), ValueError()])
+    assert asyncio.run(upstream.call(request, attempts=3)) == "ok"
+    assert len(calls) == 3
+    assert upstream.breaker.failures == 0
+
+
+def test_call_gives_up_after_attempts(resilience):
+    request, calls = failing([asyncio.TimeoutError()] * 5)
+    with pytest.raises(UpstreamUnavailable):
+        asyncio.run(upstream.call(request, attempts=2))
+    assert len(calls) == 2
+
+
+def test_call_does_not_retry_response_errors(resilience):
+    request, calls = failing([UpstreamResponseError(401)])
+    with pytest.raises(UpstreamResponseError):
+        asyncio.run(upstream.call(request))
+    assert len(calls) == 1
+    assert upstream.breaker.failures == 0
+
+
+def test_call_fails_fast_when_breaker_opens(resilience):
+    request, calls = failing([asyncio.TimeoutError()] * 10)
+    with pytest.raises(UpstreamUnavailable):
+        asyncio.run(upstream.call(request, attempts=5))
+    assert len(calls) == 3  # the breaker opened on the third failure
+
+    with pytest.raises(CircuitOpen):
+        asyncio.run(upstream.call(request))
+    assert len(calls) == 3
+
+
+def test_call_stops_when_retry_budget_is_exhausted(resilience, monkeypatch):
+    monkeypatch.setattr(upstream, "retry_budget", RetryBudget(ratio=0, min_per_second=0, capacity=1))
+    request, calls = failing([asyncio.TimeoutError()] * 2)
+    with pytest.raises(UpstreamUnavailable):
+        asyncio.run(upstream.call(request, attempts=5))
+    assert len(calls) == 2
@@ -1,26 +1,35 @@
 import base64
+import json
 import logging
 import os
-import shelve
-from asyncio import TimeoutError as ATimeoutError
+import zlib
 from datetime import datetime
 from hashlib import md5
-from json.decoder import JSONDecodeError
 
-import aiohttp
 from asyncpg.exceptions import UniqueViolationError
 
-from common.db import users_table, examsinfo_table, login_table, stats_table, regions_table
+from common import upstream, metrics
+from common.cache import TTLCache
+from common.counters import counters
+from common.single_flight import SingleFlight
+from common.db import users_table, examsinfo_table, login_table, stats_table, regions_table, results_table
 from common.strings import months
 from config import EGE_URL, EGE_HEADERS, EGE_TOKEN_URL, \
-    EGE_LOGIN_URL, proxy_url
-from mailer import Mailer
+    EGE_LOGIN_URL, proxy_url, db_table_users, db_table_login, render_cache_size, render_cache_ttl, \
+    db_table_results, db_table_broadcasts, results_cache_ttl
+import mailer
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(os.environ.get("LOGLEVEL", logging.DEBUG))
 
 cached_exam_results_dates = {}
+rendered_results_cache = TTLCache(max_size=render_cache_size, ttl=render_cache_ttl)
+# одновременные запросы результатов одного участника (кнопка, /check, auto_checker) делают один запрос к checkege
+results_flight = SingleFlight("results")
+
+results_cache_total = metrics.Counter("results_cache_total", "Interactive results requests by the saved results",
+                                      ("result",))
 
 
 async def table_count():
@@ -30,30 +39,68 @@ async def table_count():
         exams_count = await examsinfo_table.count()
         total_users = await stats_table.count()
 
-        return "Users logged: %d, not logged: %d, Total unique users: %d, Parsed exams: %d, Server time: %s" % (
-            users_count, login_count, total_users, exams_count, datetime.utcnow().strftime("%D, %H:%M:%S UTC"))
+        return "Users logged: %d, not logged: %d, Total unique users: %d, Parsed exams: %d, Server time: %s\n" \
+               "Users cache: %s" % (users_count, login_count, total_users, exams_count,
+                                    datetime.utcnow().strftime("%D, %H:%M:%S UTC"), users_table.cache.stats())
     except Exception as e:
         return str(e)
 
 
-def emoji_get():
-    with shelve.open('emoji.shelve') as emoji_db:
-        return emoji_db["counters"]
+async def emoji_get():
+    emoji_counters = await counters.get_all("emoji:")
+    return {name[len("emoji:"):]: value for name, value in emoji_counters.items()}
 
 
 def emoji_add(emoji):
-    with shelve.open('emoji.shelve') as emoji_db:
-        temp = emoji_db["counters"]
-        temp[emoji] += 1
-        emoji_db["counters"] = temp
-        return temp
+    counters.add("emoji:" + emoji)
+
+
+class UserContext:
+    def __init__(self, chat_id, user=None, login=None):
+        """
+        Rows of 'users' and 'login' tables for one chat, loaded once per update.
+        """
+        self.chat_id = chat_id
+        self.user = user
+        self.login = login
+
+    @property
+    def login_status(self):
+        if self.user:
+            return "logged"
+        elif self.login:
+            return self.login["status"]
+
+
+async def user_load_context(chat_id):
+    # logged users are usually in users_table cache, so there is nothing left to query
+    cache_version = users_table.cache.version(chat_id)
+    user = users_table.cache.get(chat_id, None)
+    if user:
+        return UserContext(chat_id, user)
+
+    rows = await users_table.custom_fetch(
+        "select u as user_row, l as login_row from (select $1::bigint) k(chat_id) "
+        "left join %s u using (chat_id) left join %s l using (chat_id)" % (db_table_users, db_table_login),
+        chat_id)
+    users_table.cache.set(chat_id, rows[0]["user_row"], cache_version)
+    return UserContext(chat_id, rows[0]["user_row"], rows[0]["login_row"])
 
 
-async def user_check_logged(chat_id):
+async def user_check_logged(chat_id, context=None):
+    if context:
+        return context.user
     return await users_table.get(chat_id)
 
 
-async def user_get_login_status(chat_id):
+async def users_filter_logged(chat_ids):
+    users = await users_table.get_many(chat_ids)
+    return {user["chat_id"]: user for user in users}
+
+
+async def user_get_login_status(chat_id, context=None):
+    if context:
+        return context.login_status
     if await users_table.get(chat_id):
         return "logged"
     else:
@@ -63,15 +110,12 @@ async def user_get_login_status(chat_id):
 
 
 async def user_clear(chat_id):
-    if await users_table.get(chat_id):
-        await users_table.delete(chat_id)
-        return True
+    await results_table.delete(chat_id)
+    return await users_table.delete(chat_id)
 
 
 async def user_login_stop(chat_id):
-    if await login_table.get(chat_id):
-        await login_table.delete(chat_id)
-        return True
+    return await login_table.delete(chat_id)
 
 
 async def user_login_start(chat_id):
@@ -129,8 +173,9 @@ async def user_get_token(chat_id):
         return user["token"]
 
 
-async def user_get_region(chat_id):
-    user = await users_table.get(chat_id)
+async def user_get_region(chat_id, user=None):
+    if not user:
+        user = await users_table.get(chat_id)
     if user:
         return user["region"]
 
@@ -140,54 +185,33 @@ async def regions_update_exams(region, response):
     for exam in response:
         exams.add(exam["ExamId"])
 
-    region_info = await regions_table.get(region)
-    if region_info:
-        exams_db = set(region_info["exams"])
-        exams.update(exams_db)
-        await regions_table.update(region, {"region": region, "exams": exams})
-    else:
-        await regions_table.insert({"region": region, "exams": exams})
+    await regions_table.upsert({"region": region, "exams": exams}, merge_arrays=("exams",))
 
 
 async def examsinfo_update(response):
-    for exam in response:
-        exam_id = exam["ExamId"]
-        title = exam["Subject"]
-        exam_date = exam["ExamDate"]
-
-        if await examsinfo_table.get(exam_id):
-            await examsinfo_table.update(exam_id, {
-                "title": title,
-                "exam_date": datetime.strptime(exam_date, "%Y-%m-%d")
-            })
-        else:
-            await examsinfo_table.insert({
-                "exam_id": exam_id,
-                "title": title,
-                "exam_date": datetime.strptime(exam_date, "%Y-%m-%d")
-            })
-
-
-def handle_captcha_delete(chat_id):
-    try:
-        os.remove("_captcha" + str(chat_id))
-    except FileNotFoundError:
-        return None
+    await examsinfo_table.upsert_many([{
+        "exam_id": exam["ExamId"],
+        "title": exam["Subject"],
+        "exam_date": datetime.strptime(exam["ExamDate"], "%Y-%m-%d")
+    } for exam in response])
 
 
 async def handle_captcha_get(chat_id):
+    """
+    Requests a new captcha for the user, returns its image bytes.
+    """
+    async def request():
+        async with upstream.session.get(EGE_TOKEN_URL, timeout=5, proxy=proxy_url) as response:
+            return await response.json()
+
     try:
-        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(verify_ssl=False)) as session:
-            response = await session.get(EGE_TOKEN_URL, timeout=5, proxy=proxy_url)
-            json = await response.json()
+        json = await upstream.call(request, attempts=1)
 
         await login_table.update(chat_id, {
             "captcha_token": json["Token"]
         })
-        with open("_captcha" + str(chat_id), "wb") as f:
-            f.write(base64.b64decode(json["Image"]))
-        return json
-    except (aiohttp.ClientConnectionError, AttributeError):
+        return base64.b64decode(json["Image"])
+    except (upstream.UpstreamUnavailable, upstream.UpstreamResponseError, AttributeError):
         return None
     except:
         return None
@@ -212,8 +236,15 @@ async def handle_login(chat_id):
                 "Captcha": user["captcha_answer"],
                 "Token": user["captcha_token"]
             }
-        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(verify_ssl=False)) as session:
-            response = await session.post(EGE_LOGIN_URL, data=params, timeout=10)
+        async def request():
+            async with upstream.session.post(EGE_LOGIN_URL, data=params, timeout=10) as response:
+                await response.read()
+            if response.status >= 500:
+                raise upstream.UpstreamResponseError(response.status)
+            return response
+
+        # a login attempt uses the user's captcha, so it is never retried
+        response = await upstream.call(request, attempts=1)
 
         if "Participant" in response.cookies:
             token = response.cookies["Participant"].value
@@ -241,7 +272,7 @@ async def handle_login(chat_id):
             return 204, user_stats_hash
         else:
             return 450, ""
-    except (aiohttp.ClientConnectionError, ATimeoutError):
+    except (upstream.UpstreamUnavailable, upstream.UpstreamResponseError):
         return 452, ""
 
 
@@ -253,52 +284,84 @@ async def pass_stats_exams_by_user_hash(user_hash, response):
     await stats_table.update(user_hash, {"exams": exams})
 
 
-async def handle_get_results_json(chat_id, attempts=5, from_auto_checker=False):
-    if attempts == 0:
+async def request_results(token):
+    headers = EGE_HEADERS.copy()
+    headers["Cookie"] += "Participant=" + token
+
+    async with upstream.session.get(EGE_URL, headers=headers, timeout=5, proxy=proxy_url) as response:
+        if not response.ok:
+            raise upstream.UpstreamResponseError(response.status)
+        json = await response.json()
+    return json["Result"]["Exams"]
+
+
+async def fetch_results(token):
+    """
+    Returns exams of the participant with {token}, concurrent calls for the same token share one upstream call.
+    """
+    return await results_flight.run(token, upstream.call, lambda: request_results(token))
+
+
+async def results_cache_get(chat_id, region):
+    """
+    Returns exams saved for the user less than results_cache_ttl seconds ago. Results saved before the start
+    of a broadcast in the user's region are not returned: they may miss the results the user is notified about.
+    """
+    rows = await results_table.custom_fetch(
+        "select r.exams from {results} r where r.chat_id = $1 and r.updated_at > $2 "
+        "and not exists (select 1 from {broadcasts} b where b.region = $3 and b.created_at >= r.updated_at)".format(
+            results=db_table_results, broadcasts=db_table_broadcasts),
+        chat_id, int(datetime.now().timestamp()) - results_cache_ttl, region)
+    if rows:
+        return json.loads(rows[0]["exams"])
+
+
+async def results_cache_set(chat_id, exams):
+    await results_table.upsert({
+        "chat_id": chat_id,
+        "exams": json.dumps(exams, ensure_ascii=False, separators=(",", ":")),
+        "updated_at": int(datetime.now().timestamp())
+    })
+
+
+async def handle_get_results_json(chat_id, from_auto_checker=False, user=None, force=False):
+    """
+    Returns (error message, exams) of the user. Interactive requests get results saved a few seconds ago
+    without a checkege request, unless {force}; the auto checker always requests checkege.
+    """
+    if not user:
+        user = await users_table.get(chat_id)
+    if not user:
+        logger.warning("User: %d results UNSUCCESSFUL: unlogged" % chat_id)
+        return "Возникла ошибка при авторизации. Пожалуйста, попробуйте войти заново с помощью /logout.", None
+
+    if not from_auto_checker and not force:
+        exams = await results_cache_get(chat_id, user["region"])
+        results_cache_total.inc(result="hit" if exams is not None else "miss")
+        if exams is not None:
+            return "", exams
+
+    try:
+        exams = await fetch_results(user["token"])
+    except upstream.UpstreamResponseError:
+        return "Сервер ЕГЭ не ответил на запрос. Пожалуйста, попробуйте повторить запрос позже.", None
+    except upstream.CircuitOpen:
         return "Сервер ЕГЭ не ответил на запрос. Попробуйте получить результаты ещё раз.", None
+    except upstream.UpstreamUnavailable as e:
+        logger.warning("User: %d results UNSUCCESSFUL: %s" % (chat_id, e))
+        return "Сервер ЕГЭ не ответил на запрос. Попробуйте получить результаты ещё раз.", None
+
+    await results_cache_set(chat_id, exams)
+    if not from_auto_checker:
+        logger.debug("User: %d results got" % chat_id)
+    return "", exams
+
+
+async def handle_get_results_json_token(token):
     try:
-        user = await users_table.get(chat_id)
-        if user:
-            token = user["token"]
-            headers = EGE_HEADERS.copy()
-            headers["Cookie"] += "Participant=" + token
-
-            async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(verify_ssl=False)) as session:
-                response = await session.get(EGE_URL, headers=headers, timeout=5, proxy=proxy_url)
-                if not response.ok:
-                    return "Сервер ЕГЭ не ответил на запрос. Пожалуйста, попробуйте повторить запрос позже.", None
-                json = await response.json()
-            if not from_auto_checker:
-                logger.debug("User: %d results got" % chat_id)
-
-            return "", json["Result"]["Exams"]
-        else:
-            logger.warning("User: %d results UNSUCCESSFUL: unlogged" % chat_id)
-            return "Возникла ошибка при авторизации. Пожалуйста, попробуйте войти заново с помощью /logout.", None
-    except aiohttp.ClientConnectionError:
-        logger.warning(str(chat_id) + " REQUESTS.PY Exc, attempt: %d" % attempts)
-        return await handle_get_results_json(chat_id, attempts - 1)
-    except (KeyError, JSONDecodeError):
-        logger.warning(str(chat_id) + str(response.content) + " attempt: %d" % attempts)
-        return await handle_get_results_json(chat_id, attempts - 1)
-    except ATimeoutError:
-        return await handle_get_results_json(chat_id, attempts - 1)
-
-
-async def handle_get_results_json_token(token, attempts=5):
-    if attempts == 0:
+        return [0, await fetch_results(token)]
+    except (upstream.UpstreamUnavailable, upstream.UpstreamResponseError):
         return [1]
-    try:
-        headers = EGE_HEADERS.copy()
-        headers["Cookie"] = "Participant=" + token
-        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(verify_ssl=False)) as session:
-            response = await session.get(EGE_URL, headers=headers, timeout=5, proxy=proxy_url)
-            json = await response.json()
-        return [0, json["Result"]["Exams"]]
-    except aiohttp.ClientConnectionError:
-        return await handle_get_results_json_token(token, attempts - 1)
-    except (KeyError, JSONDecodeError):
-        return await handle_get_results_json_token(token, attempts - 1)
 
 
 # преобразование падежа слова "балл"
@@ -321,30 +384,52 @@ def check_threshold(mark, mark_threshold, title):
         return " ✅" if mark >= mark_threshold else "❗️(порог не пройден)"
 
 
+# отпечаток экзамена по полям, изменение которых считается обновлением результатов
+def exam_fingerprint(exam):
+    fields = "%s|%s|%s|%s|%s" % (exam.get("TestMark"), exam.get("HasResult"), exam.get("IsHidden"),
+                                 exam.get("Status"), exam.get("AppealStatus"))
+    return "%08x" % zlib.crc32(fields.encode())
+
+
+# отпечатки хранятся в 'users.exams_hash' в виде "exam_id:fingerprint,..."
+def dump_exams_fingerprints(fingerprints):
+    return ",".join("%d:%s" % item for item in sorted(fingerprints.items()))
+
+
+def load_exams_fingerprints(exams_hash):
+    fingerprints = {}
+    for item in (exams_hash or "").split(","):
+        exam_id, _, fingerprint = item.partition(":")
+        if exam_id.isdigit() and fingerprint:
+            fingerprints[int(exam_id)] = fingerprint
+    return fingerprints
+
+
 # проверка на наличие обновлений с прошлой проверки
-# запускает рассылку, если необходимо
-async def check_results_updates(chat_id, response, callback_bot=None, is_user_request=True):
-    user = await users_table.get(chat_id)
+# запускает рассылку, если необходимо; возвращает id обновившихся экзаменов
+async def check_results_updates(chat_id, response, callback_bot=None, is_user_request=True, user=None):
+    if not user:
+        user = await users_table.get(chat_id)
     if user:
-        # update hash (and exam list) in 'users.db'
-        old_hash = user["exams_hash"]
+        # update fingerprints (and exam list) in 'users.db'
+        old_fingerprints = load_exams_fingerprints(user["exams_hash"])
         region = user["region"]
 
-        new_hash = md5(str(response).encode()).hexdigest()
-        exams = set()
-        for exam in response:
-            exams.add(exam["ExamId"])
+        new_fingerprints = {exam["ExamId"]: exam_fingerprint(exam) for exam in response}
+        updated_exams = {exam_id for exam_id, fingerprint in new_fingerprints.items()
+                         if old_fingerprints.get(exam_id) != fingerprint}
 
-        if old_hash != new_hash:  # результаты обновились
+        if updated_exams:  # результаты обновились
+            updated_response = [exam for exam in response if exam["ExamId"] in updated_exams]
             if is_user_request:
                 await users_table.update(chat_id, {
-                    "exams": exams,
-                    "exams_hash": new_hash
+                    "exams": set(new_fingerprints.keys()),
+                    "exams_hash": dump_exams_fingerprints(new_fingerprints)
                 })
-                await on_results_updated(response, region, chat_id, callback_bot)
+                await on_results_updated(updated_response, region, chat_id, callback_bot)
             else:
-                await on_results_updated(response, region, 1, callback_bot)
-            return True
+                await on_results_updated(updated_response, region, 1, callback_bot)
+            return updated_exams
 
     else:  # user logged out
         logger.warning("User: %d results after log out" % chat_id)
@@ -361,19 +446,17 @@ async def get_exam_result_date(exam_id):
             return cached_exam_results_dates[exam_id]
 
 
-async def parse_results_message(response, updates, is_first=False):
-    mark_sum = 0
-    show_sum = True
+def results_fingerprint(response):
+    fields = tuple((exam["ExamId"], exam["Subject"], exam["IsComposition"], exam["IsHidden"], exam["HasResult"],
+                    exam["TestMark"], exam["MinMark"]) for exam in response)
+    return md5(repr(fields).encode()).hexdigest()
 
-    message = ""
 
-    if is_first:
-        message += "*Текущие результаты:* \n\n"
-    elif updates:
-        message += "*⚡️Есть обновления⚡️*\n\n"
-    else:
-        message += "*Текущие результаты:* обновлений нет \n\n"
+async def render_results(response):
+    mark_sum = 0
+    show_sum = True
 
+    lines = []
     for exam in response:
         title = exam["Subject"]
         is_composition = exam["IsComposition"]
@@ -386,25 +469,42 @@ async def parse_results_message(response, updates, is_first=False):
             if is_composition:
                 mark_string = "*Зачёт* ✅" if mark == 1 else "*Незачёт* ❗️"
             else:
-                mark_string = "*" + str(mark) + count_case(mark, title) + check_threshold(mark, mark_threshold,
-                                                                                          title) + "*"
+                mark_string = "*%s%s%s*" % (mark, count_case(mark, title),
+                                            check_threshold(mark, mark_threshold, title))
                 mark_sum += int(mark)
         elif int(mark):
-            mark_string = "*" + str(mark) + count_case(mark, title) + check_threshold(mark,
-                                                                                      mark_threshold,
-                                                                                      title) + "* _(результат скрыт)_"
+            mark_string = "*%s%s%s* _(результат скрыт)_" % (mark, count_case(mark, title),
+                                                              check_threshold(mark, mark_threshold, title))
             show_sum = False
         else:
             result_date = await get_exam_result_date(exam["ExamId"])
             mark_string = "_ожидаются до %s_" % result_date if result_date else "_нет результата_"
             show_sum = False
 
-        message += title + " — " + mark_string + "\n"
+        lines.append("%s — %s\n" % (title, mark_string))
 
     if show_sum:
-        message += "\n_Сумма по всем предметам_ — *" + str(mark_sum) + count_case(mark_sum) + "*"
+        lines.append("\n_Сумма по всем предметам_ — *%d%s*" % (mark_sum, count_case(mark_sum)))
+
+    return "".join(lines)
+
+
+async def parse_results_message(response, updates, is_first=False):
+    if is_first:
+        header = "*Текущие результаты:* \n\n"
+    elif updates:
+        header = "*⚡️Есть обновления⚡️*\n\n"
+    else:
+        header = "*Текущие результаты:* обновлений нет \n\n"
+
+    # one rendering is shared by all users with the same results
+    fingerprint = results_fingerprint(response)
+    results = rendered_results_cache.get(fingerprint, None)
+    if results is None:
+        results = await render_results(response)
+        rendered_results_cache.set(fingerprint, results)
 
-    return message
+    return header + results
 
 
 async def on_results_updated(response, region, except_from_id=1, callback_bot=None):
@@ -421,18 +521,6 @@ async def on_results_updated(response, region, except_from_id=1, callback_bot=No
 
         if int(mark):  # есть ли результат
             if exam_id not in ignored_exams and not is_composition:  # проверка на thrown/composition
-                region_info = await regions_table.get(region)
-                if region_info:
-                    region_notified_exams = set(region_info["notified_exams"])
-                    if exam_id not in region_notified_exams:  # проверка на существующее оповещение
-                        region_notified_exams.add(exam_id)
-                        await regions_table.update(region, {"notified_exams": region_notified_exams})
-
-                        logger.warning("MAIL REGION: %d EXAM: %d %s %s" % (region, exam_id, title, date))
-
-                        mailer = Mailer(region=region,
-                                        title=title,
-                                        exam_id=exam_id,
-                                        bot=callback_bot,
-                                        except_from_id=except_from_id)
-                        mailer.run()
+                # атомарно отмечаем оповещение и ставим рассылку в outbox, это делает только первый отметивший
+                if await mailer.enqueue_broadcast(region, exam_id, title, except_from_id):
+                    logger.warning("MAIL REGION: %d EXAM: %d %s %s" % (region, exam_id, title, date))